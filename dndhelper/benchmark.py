@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+if __package__:
+    from . import dice_util as du
+    from . import combat
+    from . import draw_histogram
+    from . import generate
+    from . import roll_dice
+else:
+    import dice_util as du
+    import combat
+    import draw_histogram
+    import generate
+    import roll_dice
+
+EXAMPLES_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'examples')
+
+
+class Benchmark(object):
+
+    def __init__(self, name, unit, count, setup):
+        self.name = name
+        self.unit = unit
+        self.count = count
+        self.setup = setup
+
+    def run(self, repeat):
+        with self.setup(self.count) as workload:
+            du.seed_random_source(0)
+            best_time = None
+            for i in range(repeat):
+                start = time.perf_counter()
+                workload()
+                elapsed = time.perf_counter() - start
+                if best_time is None or elapsed < best_time:
+                    best_time = elapsed
+
+            # Tracing slows allocation down, so peak memory gets its own run.
+            tracemalloc.start()
+            try:
+                workload()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        return {
+            'unit': self.unit,
+            'count': self.count,
+            'seconds': best_time,
+            'per_second': self.count / best_time,
+            'peak_memory': peak_memory}
+
+
+def roll_options(**options):
+    defaults = {'advantage': False, 'disadvantage': False, 'critical': False,
+                'best': None, 'worst': None, 'sampler': 'auto'}
+    defaults.update(options)
+    return argparse.Namespace(**defaults)
+
+
+def roll_setup(roll_line, scalar=False, **options):
+    @contextlib.contextmanager
+    def setup(count):
+        parsed_dice = [du.parse_roll_line(roll_line)]
+        args = roll_options(**options)
+        if scalar:
+            yield lambda: [roll_dice.roll_row(parsed_dice, args)
+                           for i in range(count)]
+        else:
+            yield lambda: roll_dice.roll_chunk(parsed_dice, count, args)
+
+    return setup
+
+
+@contextlib.contextmanager
+def attack_setup(count):
+    yield lambda: combat.simulate_attacks(
+        ('1d20+5', '2d6+3', 15, False, False, count, du.random_source()))
+
+
+@contextlib.contextmanager
+def scalar_attack_setup(count):
+    attack = du.parse_roll_line('1d20+5')
+    damage = du.parse_roll_line('2d6+3')
+    yield lambda: [combat.roll_attack(attack, damage, 15)
+                   for i in range(count)]
+
+
+def template_setup(batch):
+    @contextlib.contextmanager
+    def setup(count):
+        # Word lists in the template are relative to the examples directory.
+        working_directory = os.getcwd()
+        os.chdir(EXAMPLES_DIRECTORY)
+        try:
+            template_file_name = 'main_template.txt'
+            with open(template_file_name, 'r') as template_file:
+                template_lines = template_file.readlines()
+            aggregate_generator = generate.compile_template(
+                template_file_name, template_lines)
+
+            def workload():
+                for content_map in generate.generate_samples(
+                        aggregate_generator, count, batch):
+                    pass
+
+            yield workload
+        finally:
+            os.chdir(working_directory)
+
+    return setup
+
+
+def histogram_setup(file_format):
+    @contextlib.contextmanager
+    def setup(count):
+        import numpy
+
+        du.seed_random_source(0)
+        values = du.parse_roll_line('4d6').roll_batch(count)
+        handle, file_name = tempfile.mkstemp(suffix='.' + file_format)
+        os.close(handle)
+        try:
+            if file_format == 'npy':
+                numpy.save(file_name, values.reshape(-1, 1).astype('<i4'))
+            else:
+                numpy.savetxt(file_name, values, fmt='%d')
+
+            def workload():
+                accumulator = draw_histogram.HistogramAccumulator()
+                with open(file_name, 'rb') as number_source:
+                    for first_column, numbers in \
+                            draw_histogram.read_chunks(number_source):
+                        accumulator.add(numbers[:, 0])
+
+            yield workload
+        finally:
+            os.remove(file_name)
+
+    return setup
+
+
+BENCHMARKS = [
+    Benchmark('roll_1d20+5', 'rolls', 10 ** 6, roll_setup('1d20+5')),
+    Benchmark('roll_1d20+5_scalar', 'rolls', 10 ** 5,
+              roll_setup('1d20+5', scalar=True)),
+    Benchmark('roll_4d6_best_3', 'rolls', 10 ** 6,
+              roll_setup('4d6', best=3)),
+    Benchmark('roll_100d6', 'rolls', 10 ** 5, roll_setup('100d6')),
+    Benchmark('roll_100d6_dice', 'rolls', 10 ** 5,
+              roll_setup('100d6', sampler='dice')),
+    Benchmark('attack', 'attacks', 10 ** 6, attack_setup),
+    Benchmark('attack_scalar', 'attacks', 10 ** 5, scalar_attack_setup),
+    Benchmark('npc', 'NPCs', 10 ** 4, template_setup(False)),
+    Benchmark('npc_batch', 'NPCs', 10 ** 5, template_setup(True)),
+    Benchmark('histogram_npy_1e6', 'samples', 10 ** 6,
+              histogram_setup('npy')),
+    Benchmark('histogram_npy_1e7', 'samples', 10 ** 7,
+              histogram_setup('npy')),
+    Benchmark('histogram_text_1e6', 'samples', 10 ** 6,
+              histogram_setup('txt')),
+    Benchmark('histogram_text_1e7', 'samples', 10 ** 7,
+              histogram_setup('txt')),
+]
+
+
+def compare_results(results, baseline, tolerance):
+    regressions = []
+    print("")
+    print("{:<22} | {:>15} | {:>8} | {:>8}".format(
+        "Compared to baseline", "per second", "speed", "memory"))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        speed_change = result['per_second'] / \
+            baseline[name]['per_second'] - 1.0
+        memory_change = float(result['peak_memory']) / \
+            max(1, baseline[name]['peak_memory']) - 1.0
+        flags = []
+        if speed_change < -tolerance:
+            flags.append("slower")
+        if memory_change > tolerance:
+            flags.append("more memory")
+        if len(flags) > 0:
+            regressions.append(name)
+
+        print("{:<22} | {:>15.1f} | {:>+7.1f}% | {:>+7.1f}% {}".format(
+            name, result['per_second'], 100.0 * speed_change,
+            100.0 * memory_change, " ".join(flags)).rstrip())
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Throughput and peak memory benchmarks for the dice, combat, histogram and template generation hot paths.')
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='write the results as JSON to this file')
+    parser.add_argument(
+        '--compare',
+        help='JSON results of an earlier run to compare against, exits with status 1 on regressions',
+        type=argparse.FileType('r'))
+    parser.add_argument(
+        '--tolerance',
+        help='relative slowdown or memory growth allowed before --compare reports a regression',
+        type=float,
+        default=0.1)
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help='number of timed runs per benchmark, the fastest one is reported',
+        type=int,
+        default=3)
+    parser.add_argument(
+        '-k',
+        '--filter',
+        help='only run benchmarks whose name contains this string')
+
+    args = parser.parse_args()
+
+    import numpy
+
+    results = {}
+    print("{:<22} | {:>22} | {:>12}".format(
+        "Benchmark", "throughput", "peak memory"))
+    for benchmark in BENCHMARKS:
+        if args.filter is not None and args.filter not in benchmark.name:
+            continue
+
+        result = benchmark.run(max(1, args.repeat))
+        results[benchmark.name] = result
+        print("{:<22} | {:>12.1f} {:<9} | {:>9.1f} MB".format(
+            benchmark.name, result['per_second'], benchmark.unit + "/s",
+            result['peak_memory'] / 1048576.0))
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': numpy.__version__,
+                'machine': platform.machine(),
+                'benchmarks': results}, output_file, indent=2, sort_keys=True)
+            output_file.write("\n")
+
+    if args.compare is not None:
+        baseline = json.load(args.compare)['benchmarks']
+        regressions = compare_results(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("")
+            print("Regressions: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,58 +1,276 @@
 #!/usr/bin/env python
 
 import argparse
-import dice_util as du
-
-parser = argparse.ArgumentParser(
-    description='Simple attack roller for D&D 5th edition.')
-parser.add_argument('attack_roll', help='Code for the attack roll, ex: 1d20+5')
-parser.add_argument('damage_roll', help='Code for the damage roll, ex: 3d6+2')
-parser.add_argument('target_ac', help='Target AC to hit, ex: 18')
-parser.add_argument(
-    '-c',
-    help='number of times to repeat the attack',
-    type=int)
-
-parser.add_argument('-a', help='roll width advantage', action='store_true')
-parser.add_argument('-d', help='roll width disadvantage', action='store_true')
-
-args = parser.parse_args()
-
-repeats = 1
-if args.c is not None:
-    if args.c >= 1:
-        repeats = args.c
-
-try:
-    for i in range(repeats):
+import functools
+import multiprocessing
+if __package__:
+    from . import dice_util as du
+else:
+    import dice_util as du
+
+SIMULATION_CHUNK = 1 << 20
+
+
+def simulate_attacks(task):
+    import numpy
+
+    (attack_roll, damage_roll, target_ac, advantage, disadvantage, count,
+     source) = task
+    du.set_random_source(source)
+
+    attack = du.parse_roll_line(attack_roll)
+    attack_die = du.RollExpression(attack.dice[:1], 0)
+    damage = du.parse_roll_line(damage_roll)
+    crit_damage = damage.critical()
+
+    low = min(0, damage.minimum(), crit_damage.minimum())
+    high = max(0, damage.maximum(), crit_damage.maximum())
+    histogram = numpy.zeros(high - low + 1, dtype=numpy.int64)
+    hits = 0
+    crits = 0
+
+    for start in range(0, count, SIMULATION_CHUNK):
+        n = min(SIMULATION_CHUNK, count - start)
+
+        attack_results = attack_die.roll_batch(n)
+        if advantage:
+            attack_results = numpy.maximum(
+                attack_results, attack_die.roll_batch(n))
+        elif disadvantage:
+            attack_results = numpy.minimum(
+                attack_results, attack_die.roll_batch(n))
+
+        critical = attack_results == 20
+        hit = critical | (attack_results + attack.bonus >= target_ac)
+        normal_hit = hit & ~critical
+
+        damage_results = numpy.zeros(n, dtype=numpy.int64)
+        damage_results[normal_hit] = damage.roll_totals(
+            int(normal_hit.sum()))
+        damage_results[critical] = crit_damage.roll_totals(
+            int(critical.sum()))
+
+        histogram += numpy.bincount(
+            damage_results - low, minlength=len(histogram))
+        hits += int(hit.sum())
+        crits += int(critical.sum())
+
+    return hits, crits, low, histogram
+
+
+def run_simulation(attack_roll, damage_roll, target_ac, advantage,
+                   disadvantage, repeats, jobs=1):
+    jobs = max(1, min(jobs, repeats))
+    sources = du.random_source().spawn(jobs)
+    tasks = []
+    for i in range(jobs):
+        count = repeats // jobs + (1 if i < repeats % jobs else 0)
+        tasks.append((attack_roll, damage_roll, target_ac,
+                      advantage, disadvantage, count,
+                      sources[i]))
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(simulate_attacks, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        previous_source = du.random_source()
+        try:
+            results = [simulate_attacks(tasks[0])]
+        finally:
+            du.set_random_source(previous_source)
+
+    hits = sum(result[0] for result in results)
+    crits = sum(result[1] for result in results)
+    low = results[0][2]
+    histogram = sum(result[3] for result in results)
+
+    return hits, crits, du.RollDistribution(low, histogram)
+
+
+def attack_distributions(attack_roll, damage_roll, advantage, disadvantage):
+    attack = du.parse_roll_line(attack_roll)
+    damage = du.parse_roll_line(damage_roll)
+
+    natural_roll = du.RollExpression(attack.dice[:1], 0).pmf()
+    if advantage:
+        natural_roll = du.extreme_of_two(natural_roll, highest=True)
+    elif disadvantage:
+        natural_roll = du.extreme_of_two(natural_roll, highest=False)
+
+    return (natural_roll, attack.bonus, damage.pmf(),
+            damage.critical().pmf())
+
+
+def attack_outcome(distributions, target_ac):
+    natural_roll, attack_bonus, damage, crit_damage = distributions
+
+    crit_chance = natural_roll.probability(20)
+    hit_chance = natural_roll.prob_at_least(target_ac - attack_bonus)
+    if target_ac - attack_bonus > 20:
+        hit_chance += crit_chance
+    normal_hit_chance = hit_chance - crit_chance
+
+    damage_distribution = du.mix_distributions([
+        (1.0 - hit_chance, du.RollDistribution(0, [1.0])),
+        (normal_hit_chance, damage),
+        (crit_chance, crit_damage)])
+
+    return hit_chance, crit_chance, damage_distribution
+
+
+def print_attack_sweep(distributions, target_acs):
+    print("    AC | P(hit)    | P(crit)   | Avg damage")
+    for target_ac in target_acs:
+        hit_chance, crit_chance, damage_distribution = attack_outcome(
+            distributions, target_ac)
+        print("{:>6} | {:>8.4f}% | {:>8.4f}% | {:.4f}".format(
+            target_ac,
+            100.0 * hit_chance,
+            100.0 * crit_chance,
+            damage_distribution.mean()))
+
+
+def print_simulation(repeats, hits, crits, distribution):
+    print("Attacks:         {}".format(repeats))
+    print_damage_report(
+        float(hits) / repeats, float(crits) / repeats, distribution)
+
+
+def print_damage_report(hit_chance, crit_chance, distribution):
+    print("Hit chance:      {:.4f}%".format(100.0 * hit_chance))
+    print("Crit chance:     {:.4f}%".format(100.0 * crit_chance))
+    print("Damage:          avg = {:.4f}, std = {:.4f}".format(
+        distribution.mean(), distribution.std()))
+    print("Percentiles (5/25/50/75/95): {}".format(
+        " / ".join(str(distribution.percentile(q))
+                   for q in (5, 25, 50, 75, 95))))
+    print("----------------------------")
+
+    highest = distribution.probabilities.max()
+    for value in distribution.values():
+        probability = distribution.probability(value)
+        print("{:>6} | {:>8.4f}% | {}".format(
+            value,
+            100.0 * probability,
+            "#" * int(round(50 * probability / highest))))
+
+
+@functools.lru_cache(maxsize=256)
+def attack_die(attack):
+    return du.RollExpression(attack.dice[:1], 0)
+
+
+def roll_attack(attack, damage, target_ac, advantage=False,
+                disadvantage=False):
+    natural_die = attack_die(attack)
+    attack_result = natural_die.roll()
+    if advantage:
+        attack_result = max(attack_result, natural_die.roll())
+    elif disadvantage:
+        attack_result = min(attack_result, natural_die.roll())
+
+    attack_total = attack_result + attack.bonus
+    if attack_result == 20:
+        return attack_total, "CRITICAL HIT", damage.critical().roll()
+    elif attack_total >= target_ac:
+        return attack_total, "HIT", damage.roll()
+    else:
+        return attack_total, "MISS", None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simple attack roller for D&D 5th edition.')
+    parser.add_argument('attack_roll', help='Code for the attack roll, ex: 1d20+5')
+    parser.add_argument('damage_roll', help='Code for the damage roll, ex: 3d6+2')
+    parser.add_argument(
+        'target_ac',
+        help='Target AC to hit, ex: 18 (with --exact also a range, ex: 10-25)')
+    parser.add_argument(
+        '-c',
+        help='number of times to repeat the attack',
+        type=int)
+
+    parser.add_argument('-a', help='roll width advantage', action='store_true')
+    parser.add_argument('-d', help='roll width disadvantage', action='store_true')
+    parser.add_argument(
+        '-s',
+        '--stats',
+        help='simulate all attacks at once and only print hit/crit rates and damage statistics',
+        action='store_true')
+    parser.add_argument(
+        '-e',
+        '--exact',
+        help='compute exact hit/crit chances and the damage distribution instead of rolling',
+        action='store_true')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='number of worker processes for --stats',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--seed',
+        help='seed for all rolls, the same seed always gives the same results',
+        type=int)
+    parser.add_argument(
+        '--rng',
+        help='NumPy bit generator for batch rolls',
+        choices=sorted(du.BIT_GENERATORS),
+        default='pcg64')
+
+    args = parser.parse_args()
+
+    repeats = 1
+    if args.c is not None:
+        if args.c >= 1:
+            repeats = args.c
+
+    du.seed_random_source(args.seed, args.rng)
+
+    try:
+        if args.exact:
+            distributions = attack_distributions(
+                args.attack_roll, args.damage_roll, args.a, args.d)
+            if '-' in args.target_ac.strip('-'):
+                low_ac, high_ac = args.target_ac.split('-')
+                print_attack_sweep(
+                    distributions, range(int(low_ac), int(high_ac) + 1))
+            else:
+                print_damage_report(
+                    *attack_outcome(distributions, int(args.target_ac)))
+            return
+
         target_ac = int(args.target_ac)
 
-        attack_dice, attack_bonus = du.parse_roll_line(args.attack_roll)
-        attack_result = du.roll_batch(attack_dice[0])
-        if args.a:
-            attack_result = max(attack_result, du.roll_batch(attack_dice[0]))
-        elif args.d:
-            attack_result = max(attack_result, du.roll_batch(attack_dice[0]))
-
-        attack_roll = attack_result + attack_bonus
-        print("Attack roll:     {} vs AC {}".format(attack_roll, target_ac))
-
-        damage_dice, damage_bonus = du.parse_roll_line(args.damage_roll)
-        damage = du.roll_all(damage_dice) + damage_bonus
-        if attack_result == 20:
-            damage += du.roll_all(damage_dice)
-
-        if attack_result == 20:
-            print("CRITICAL HIT!")
-            print("Damage roll:     {}".format(damage))
-        elif attack_result + attack_bonus >= target_ac:
-            print("HIT!")
-            print("Damage roll:     {}".format(damage))
-        else:
-            print("MISS!")
-
-        if i < repeats - 1:
-            print("----------------------------")
-
-except Exception as ex:
-    print(ex.args[0])
+        if args.stats:
+            hits, crits, distribution = run_simulation(
+                args.attack_roll, args.damage_roll, target_ac, args.a,
+                args.d, repeats, args.jobs)
+            print_simulation(repeats, hits, crits, distribution)
+            return
+
+        attack = du.parse_roll_line(args.attack_roll)
+        damage = du.parse_roll_line(args.damage_roll)
+
+        for i in range(repeats):
+            attack_total, outcome, damage_total = roll_attack(
+                attack, damage, target_ac, args.a, args.d)
+            print("Attack roll:     {} vs AC {}".format(attack_total, target_ac))
+            print(outcome + "!")
+            if damage_total is not None:
+                print("Damage roll:     {}".format(damage_total))
+
+            if i < repeats - 1:
+                print("----------------------------")
+
+    except Exception as ex:
+        print(ex.args[0])
+
+
+if __name__ == '__main__':
+    main()
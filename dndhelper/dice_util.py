@@ -1,16 +1,238 @@
+import functools
+import hashlib
+import heapq
+import math
 import random
 import sys
 import argparse
 import re
 
+BIT_GENERATORS = {'pcg64': 'PCG64', 'philox': 'Philox'}
+ROLL_DTYPE = 'int32'
+PMF_SAMPLING_DICE = 16
+DERIVED_STREAM_KEY = 2 ** 32
+
+
+class RandomSource(object):
+
+    def __init__(self, seed=None, bit_generator='pcg64', spawn_key=()):
+        if bit_generator not in BIT_GENERATORS:
+            raise ValueError("Unknown bit generator {}, expected one of: "
+                             "{}.".format(bit_generator,
+                                          ", ".join(sorted(BIT_GENERATORS))))
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(128)
+
+        self.seed = seed
+        self.bit_generator = bit_generator
+        self.spawn_key = tuple(spawn_key)
+        self.children_spawned = 0
+        self.derived_sources = {}
+
+        # Single draws stay on the stdlib generator so they never need NumPy;
+        # both streams are derived from the same seed and spawn key.
+        key = "{}:{}".format(seed, self.spawn_key).encode('utf-8')
+        self.scalar = random.Random(int(hashlib.sha256(key).hexdigest(), 16))
+        self.bulk = None
+
+    def spawn(self, n):
+        children = [RandomSource(self.seed, self.bit_generator,
+                                 self.spawn_key + (self.children_spawned + i,))
+                    for i in range(n)]
+        self.children_spawned += n
+        return children
+
+    def derive(self, *key):
+        # A stream per key, so results drawn from it do not depend on how
+        # draws from other streams are interleaved with it.
+        child = self.derived_sources.get(key)
+        if child is None:
+            digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+            child = RandomSource(
+                self.seed, self.bit_generator,
+                self.spawn_key + (DERIVED_STREAM_KEY, int(digest[:16], 16)))
+            self.derived_sources[key] = child
+
+        return child
+
+    def generator(self):
+        if self.bulk is None:
+            import numpy
+
+            bit_generator = getattr(
+                numpy.random, BIT_GENERATORS[self.bit_generator])
+            self.bulk = numpy.random.Generator(bit_generator(
+                numpy.random.SeedSequence(
+                    self.seed, spawn_key=self.spawn_key)))
+
+        return self.bulk
+
+    def randint(self, low, high):
+        return self.scalar.randint(low, high)
+
+    def randrange(self, stop):
+        return self.scalar.randrange(stop)
+
+    def random(self):
+        return self.scalar.random()
+
+    def choice(self, sequence):
+        return self.scalar.choice(sequence)
+
+    def shuffle(self, sequence):
+        self.scalar.shuffle(sequence)
+
+    def integers(self, low, high, size, dtype='int64'):
+        return self.generator().integers(low, high, size=size, dtype=dtype)
+
+    def random_sample(self, size):
+        return self.generator().random(size)
+
+
+_random_source = RandomSource()
+
+
+def random_source():
+    return _random_source
+
+
+def set_random_source(source):
+    global _random_source
+    _random_source = source
+    return source
+
+
+def seed_random_source(seed=None, bit_generator='pcg64'):
+    return set_random_source(RandomSource(seed, bit_generator))
+
+
+def alias_table(weights):
+    count = len(weights)
+    total = float(sum(weights))
+    scaled = [w * count / total for w in weights]
+
+    # Vose's alias method: pair each under-full column with an over-full
+    # one so every column holds at most two outcomes.
+    accept = [1.0] * count
+    aliases = list(range(count))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        accept[s] = scaled[s]
+        aliases[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    return accept, aliases
+
+
+def widen_counts(counts, offset, low, high):
+    import numpy
+
+    # Histogram counts live on the last axis starting at offset; the
+    # widened copy covers both the old range and low..high.
+    if counts.shape[-1] > 0:
+        low = min(low, offset)
+        high = max(high, offset + counts.shape[-1] - 1)
+
+    widened = numpy.zeros(
+        counts.shape[:-1] + (high - low + 1,), dtype=counts.dtype)
+    widened[..., offset - low:offset - low + counts.shape[-1]] = counts
+    return widened, low
+
+
+def _lru_cache(maxsize):
+    # Python 2 (generate.py) has no lru_cache and never parses roll lines.
+    if hasattr(functools, 'lru_cache'):
+        return functools.lru_cache(maxsize=maxsize)
+    return lambda function: function
+
+
+def group_dice_by_type(die_param_list):
+    import numpy
+
+    groups = []
+    group_indices = {}
+    for i, (op_type, die_count, die_type) in enumerate(die_param_list):
+        if die_type not in group_indices:
+            group_indices[die_type] = len(groups)
+            groups.append((die_type, []))
+        groups[group_indices[die_type]][1].append(i)
+
+    die_groups = []
+    for die_type, indices in groups:
+        counts = tuple(die_param_list[i][1] for i in indices)
+        signs = numpy.repeat(numpy.array(
+            [-1 if die_param_list[i][0] == '-' else 1 for i in indices],
+            dtype=ROLL_DTYPE), counts)
+        signs.flags.writeable = False
+        die_groups.append((die_type, tuple(indices), counts, signs))
+
+    return tuple(die_groups)
+
+
+def roll_die_group(die_type, signs, repeats):
+    # Every die type has its own stream, so splitting a batch into chunks
+    # does not reorder the draws of different dice.
+    rolls = _random_source.derive('dice', die_type).integers(
+        1, die_type + 1, size=(repeats, len(signs)), dtype=ROLL_DTYPE)
+    if signs.min() < 0:
+        rolls *= signs
+
+    return rolls
+
+
+def roll_line_pool(die_param_list, repeats, die_groups=None):
+    import numpy
+
+    if die_groups is None:
+        die_groups = group_dice_by_type(die_param_list)
+
+    pools = [roll_die_group(die_type, signs, repeats)
+             for die_type, indices, counts, signs in die_groups]
+    if len(pools) == 1:
+        return pools[0]
+    return numpy.concatenate(pools, axis=1)
+
+
+def roll_line_batch(die_param_list, bonus, repeats, per_die=False,
+                    die_groups=None):
+    import numpy
+
+    if die_groups is None:
+        die_groups = group_dice_by_type(die_param_list)
+
+    totals = numpy.full(repeats, bonus, dtype=numpy.int64)
+    die_rolls = [None] * len(die_param_list)
+
+    # One draw per die type covers every group of that type in every repeat.
+    for die_type, indices, counts, signs in die_groups:
+        rolls = roll_die_group(die_type, signs, repeats)
+        totals += rolls.sum(axis=1)
+
+        if per_die:
+            split_rolls = numpy.split(rolls, numpy.cumsum(counts)[:-1], axis=1)
+            for i, group_rolls in zip(indices, split_rolls):
+                die_rolls[i] = group_rolls
+
+    if per_die:
+        return totals, die_rolls
+    else:
+        return totals
+
 
 def roll_batch(die_params, sumup=True):
     op_type, die_count, die_type = die_params
 
-    roll_results = [random.randint(1, die_type) for i in range(die_count)]
-    for i in range(len(roll_results)):
-        if op_type == '-':
-            roll_results[i] = -roll_results[i]
+    roll_results = [_random_source.randint(1, die_type)
+                    for i in range(die_count)]
+    if op_type == '-':
+        roll_results = [-result for result in roll_results]
 
     if sumup:
         return sum(roll_results)
@@ -27,18 +249,439 @@ def roll_all(die_param_list, sumup=True):
         return roll_results
 
 
+def keep_dice(die_rolls, keep, highest=True):
+    import numpy
+
+    die_rolls = numpy.asarray(die_rolls)
+    die_count = die_rolls.shape[1]
+    if keep > die_count:
+        raise ValueError("You can't pick out more dice than you roll.")
+    elif keep == die_count:
+        return die_rolls.sum(axis=1)
+    elif keep <= 0:
+        return numpy.zeros(die_rolls.shape[0], dtype=die_rolls.dtype)
+
+    # Partial selection puts the kept dice on one side of the pivot without
+    # ordering either side.
+    if highest:
+        return numpy.partition(
+            die_rolls, die_count - keep, axis=1)[:, die_count - keep:].sum(
+                axis=1)
+    else:
+        return numpy.partition(
+            die_rolls, keep - 1, axis=1)[:, :keep].sum(axis=1)
+
+
+def drop_dice(die_rolls, drop, highest=True):
+    import numpy
+
+    die_rolls = numpy.asarray(die_rolls)
+    return keep_dice(die_rolls, die_rolls.shape[1] - drop, not highest)
+
+
+class RollDistribution(object):
+
+    def __init__(self, offset, probabilities):
+        import numpy
+
+        probabilities = numpy.asarray(probabilities, dtype=numpy.float64)
+        nonzero = numpy.flatnonzero(probabilities)
+        if len(nonzero) > 0:
+            offset += nonzero[0]
+            probabilities = probabilities[nonzero[0]:nonzero[-1] + 1]
+
+        self.offset = int(offset)
+        self.probabilities = probabilities / probabilities.sum()
+        self.cumulative = numpy.cumsum(self.probabilities)
+        self.accept = None
+        self.aliases = None
+
+    def values(self):
+        import numpy
+
+        return numpy.arange(
+            self.offset, self.offset + len(self.probabilities))
+
+    def minimum(self):
+        return self.offset
+
+    def maximum(self):
+        return self.offset + len(self.probabilities) - 1
+
+    def mean(self):
+        import numpy
+
+        return float(numpy.dot(self.values(), self.probabilities))
+
+    def variance(self):
+        import numpy
+
+        deviations = self.values() - self.mean()
+        return float(numpy.dot(deviations * deviations, self.probabilities))
+
+    def std(self):
+        return self.variance() ** 0.5
+
+    def probability(self, value):
+        i = value - self.offset
+        if i < 0 or i >= len(self.probabilities):
+            return 0.0
+        return float(self.probabilities[i])
+
+    def prob_at_least(self, value):
+        i = value - self.offset
+        if i <= 0:
+            return 1.0
+        elif i >= len(self.probabilities):
+            return 0.0
+        return float(1.0 - self.cumulative[i - 1])
+
+    def build_alias_table(self):
+        import numpy
+
+        accept, aliases = alias_table(self.probabilities.tolist())
+        self.accept = numpy.array(accept)
+        self.aliases = numpy.array(aliases, dtype=numpy.int64)
+
+    def sample(self, size):
+        import numpy
+
+        if self.aliases is None:
+            self.build_alias_table()
+
+        # A single uniform draw picks the column with its integer part and
+        # decides between the column and its alias with the fraction, so a
+        # value costs the same however many dice made the distribution.
+        scaled = _random_source.random_sample(size) * len(self.probabilities)
+        columns = scaled.astype(numpy.int64)
+        numpy.minimum(columns, len(self.probabilities) - 1, out=columns)
+        keep = scaled - columns < self.accept[columns]
+        return numpy.where(keep, columns, self.aliases[columns]) + \
+            self.offset
+
+    def percentile(self, q):
+        import numpy
+
+        i = numpy.searchsorted(self.cumulative, q / 100.0 - 1e-12)
+        return self.offset + int(min(i, len(self.probabilities) - 1))
+
+    def __add__(self, other):
+        import numpy
+
+        if isinstance(other, RollDistribution):
+            return RollDistribution(
+                self.offset + other.offset,
+                numpy.convolve(self.probabilities, other.probabilities))
+        else:
+            return RollDistribution(self.offset + other, self.probabilities)
+
+    def __neg__(self):
+        return RollDistribution(-self.maximum(), self.probabilities[::-1])
+
+
+def die_pmf(die_type):
+    import numpy
+
+    return RollDistribution(1, numpy.ones(die_type))
+
+
+def dice_pmf(die_count, die_type):
+    # Square-and-multiply keeps large pools at O(log n) convolutions.
+    result = RollDistribution(0, [1.0])
+    power = die_pmf(die_type)
+    while die_count > 0:
+        if die_count & 1:
+            result = result + power
+        die_count >>= 1
+        if die_count > 0:
+            power = power + power
+
+    return result
+
+
+def _binomial_probabilities(n, p, log_factorials):
+    import numpy
+
+    if p >= 1.0:
+        probabilities = numpy.zeros(n + 1)
+        probabilities[n] = 1.0
+        return probabilities
+
+    # Log space, so pools of any size neither overflow nor lose precision.
+    j = numpy.arange(n + 1)
+    return numpy.exp(
+        log_factorials[n] - log_factorials[j] - log_factorials[n - j] +
+        j * math.log(p) + (n - j) * math.log1p(-p))
+
+
+def keep_dice_pmf(die_count, die_type, keep, highest=True):
+    import numpy
+
+    if keep > die_count:
+        raise ValueError("You can't pick out more dice than you roll.")
+
+    # ways[used][s]: probability that `used` dice landed on the faces seen
+    # so far with the kept ones summing to s. Each remaining die shows the
+    # next face with probability 1 / (faces left).
+    max_sum = keep * die_type
+    ways = numpy.zeros((die_count + 1, max_sum + 1))
+    ways[0, 0] = 1.0
+    log_factorials = numpy.array(
+        [math.lgamma(i + 1) for i in range(die_count + 1)])
+
+    if highest:
+        faces = range(die_type, 0, -1)
+    else:
+        faces = range(1, die_type + 1)
+
+    for faces_seen, face in enumerate(faces):
+        new_ways = numpy.zeros_like(ways)
+        for used in range(die_count + 1):
+            if not ways[used].any():
+                continue
+            weights = _binomial_probabilities(
+                die_count - used, 1.0 / (die_type - faces_seen),
+                log_factorials)
+            for j in range(die_count - used + 1):
+                kept_sum = min(j, max(0, keep - used)) * face
+                new_ways[used + j, kept_sum:] += \
+                    weights[j] * ways[used, :max_sum + 1 - kept_sum]
+        ways = new_ways
+
+    return RollDistribution(0, ways[die_count])
+
+
+def extreme_of_two(distribution, highest=True):
+    import numpy
+
+    cumulative = distribution.cumulative
+    if highest:
+        probabilities = numpy.diff(cumulative ** 2, prepend=0.0)
+    else:
+        at_least = 1.0 - numpy.concatenate(([0.0], cumulative[:-1]))
+        probabilities = at_least ** 2 - \
+            numpy.concatenate((at_least[1:], [0.0])) ** 2
+
+    return RollDistribution(distribution.offset, probabilities)
+
+
+def extreme_of_two_pmf(die_type, highest=True):
+    return extreme_of_two(die_pmf(die_type), highest)
+
+
+def mix_distributions(weighted_distributions):
+    import numpy
+
+    weighted_distributions = [(weight, distribution)
+                              for weight, distribution in weighted_distributions
+                              if weight > 0]
+    low = min(distribution.minimum()
+              for weight, distribution in weighted_distributions)
+    high = max(distribution.maximum()
+               for weight, distribution in weighted_distributions)
+
+    probabilities = numpy.zeros(high - low + 1)
+    for weight, distribution in weighted_distributions:
+        start = distribution.offset - low
+        probabilities[start:start + len(distribution.probabilities)] += \
+            weight * distribution.probabilities
+
+    return RollDistribution(low, probabilities)
+
+
+def _signed_group_pmf(op_type, group_pmf_function, highest):
+    # Keeping the highest of negated dice keeps the lowest magnitudes.
+    if op_type == '-':
+        return -group_pmf_function(not highest)
+    else:
+        return group_pmf_function(highest)
+
+
+def roll_line_pmf(die_param_list, bonus, advantage=False,
+                  disadvantage=False, critical=False, best=None, worst=None):
+    if len(die_param_list) == 0:
+        return RollDistribution(bonus, [1.0])
+
+    op_type, die_count, die_type = die_param_list[0]
+    if advantage or disadvantage:
+        return _signed_group_pmf(
+            op_type,
+            lambda highest: extreme_of_two_pmf(die_type, highest),
+            advantage) + bonus
+    elif best is not None or worst is not None:
+        if len(die_param_list) > 1:
+            raise ValueError("You can use only one type of die.")
+        return _signed_group_pmf(
+            op_type,
+            lambda highest: keep_dice_pmf(
+                die_count, die_type,
+                best if best is not None else worst, highest),
+            best is not None) + bonus
+
+    distribution = RollDistribution(bonus, [1.0])
+    for op_type, die_count, die_type in die_param_list:
+        if critical:
+            die_count *= 2
+        group_pmf = dice_pmf(die_count, die_type)
+        if op_type == '-':
+            group_pmf = -group_pmf
+        distribution = distribution + group_pmf
+
+    return distribution
+
+
+def roll_pmf(roll_expression, advantage=False, disadvantage=False,
+             critical=False, best=None, worst=None):
+    # Sums that only differ in the order or grouping of their dice share
+    # one cache entry. Advantage and kept dice depend on which die comes
+    # first, so those keep the roll as written.
+    if not (advantage or disadvantage or best is not None or
+            worst is not None):
+        roll_expression = roll_expression.canonical()
+    return _cached_roll_pmf(
+        roll_expression, advantage, disadvantage, critical, best, worst)
+
+
+@_lru_cache(maxsize=256)
+def _cached_roll_pmf(roll_expression, advantage, disadvantage, critical,
+                     best, worst):
+    return roll_expression.pmf(
+        advantage=advantage, disadvantage=disadvantage, critical=critical,
+        best=best, worst=worst)
+
+
+class RollExpression(object):
+    __slots__ = ('dice', 'bonus', '_die_groups')
+
+    def __init__(self, dice, bonus):
+        object.__setattr__(self, 'dice', tuple(tuple(die) for die in dice))
+        object.__setattr__(self, 'bonus', bonus)
+        object.__setattr__(self, '_die_groups', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RollExpression objects are immutable.")
+
+    def __iter__(self):
+        return iter((list(self.dice), self.bonus))
+
+    def __eq__(self, other):
+        return (isinstance(other, RollExpression) and
+                self.dice == other.dice and self.bonus == other.bonus)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.dice, self.bonus))
+
+    def __str__(self):
+        output_string = ""
+        for op_type, die_count, die_type in self.dice:
+            if output_string != "" or op_type == '-':
+                output_string = output_string + op_type
+            output_string = output_string + \
+                str(die_count) + 'd' + str(die_type)
+
+        if output_string == "":
+            output_string = str(self.bonus)
+        elif self.bonus > 0:
+            output_string = output_string + "+" + str(self.bonus)
+        elif self.bonus < 0:
+            output_string = output_string + str(self.bonus)
+
+        return output_string
+
+    def __repr__(self):
+        return "RollExpression('{}')".format(self)
+
+    def minimum(self):
+        return self.bonus + sum(
+            die_count if op_type == '+' else -die_count * die_type
+            for op_type, die_count, die_type in self.dice)
+
+    def maximum(self):
+        return self.bonus + sum(
+            die_count * die_type if op_type == '+' else -die_count
+            for op_type, die_count, die_type in self.dice)
+
+    def canonical(self):
+        counts = {}
+        for op_type, die_count, die_type in self.dice:
+            counts[(die_type, op_type)] = \
+                counts.get((die_type, op_type), 0) + die_count
+
+        return RollExpression(
+            [(op_type, counts[(die_type, op_type)], die_type)
+             for die_type, op_type in sorted(counts)],
+            self.bonus)
+
+    def critical(self):
+        return RollExpression(
+            [(op_type, die_count * 2, die_type)
+             for op_type, die_count, die_type in self.dice],
+            self.bonus)
+
+    def roll(self):
+        return roll_all(self.dice) + self.bonus
+
+    def groups(self):
+        # Grouping builds NumPy arrays, so it waits for the first batch.
+        if self._die_groups is None:
+            object.__setattr__(
+                self, '_die_groups', group_dice_by_type(self.dice))
+
+        return self._die_groups
+
+    def roll_batch(self, repeats, per_die=False):
+        return roll_line_batch(
+            self.dice, self.bonus, repeats, per_die=per_die,
+            die_groups=self.groups())
+
+    def die_count(self):
+        return sum(die_count for op_type, die_count, die_type in self.dice)
+
+    def sample_batch(self, repeats, **modifiers):
+        return roll_pmf(self, **modifiers).sample(repeats)
+
+    def roll_totals(self, repeats, sampler='auto'):
+        if sampler == 'pmf' or (sampler == 'auto' and
+                                self.die_count() >= PMF_SAMPLING_DICE):
+            return self.sample_batch(repeats)
+        return self.roll_batch(repeats)
+
+    def roll_keep(self, keep, highest=True):
+        if keep > self.die_count():
+            raise ValueError("You can't pick out more dice than you roll.")
+
+        die_rolls = []
+        for die_params in self.dice:
+            die_rolls.extend(roll_batch(die_params, sumup=False))
+        if highest:
+            return sum(heapq.nlargest(keep, die_rolls)) + self.bonus
+        else:
+            return sum(heapq.nsmallest(keep, die_rolls)) + self.bonus
+
+    def roll_keep_batch(self, repeats, keep, highest=True):
+        pool = roll_line_pool(self.dice, repeats, self.groups())
+        return keep_dice(pool, keep, highest) + self.bonus
+
+    def pmf(self, **modifiers):
+        return roll_line_pmf(self.dice, self.bonus, **modifiers)
+
+
 def parse_dice_code(die_code):
-    die_count = die_code.split('d')[0]
+    die_count, die_type = die_code.split('d')
     if die_count == '':
         die_count = 1
     else:
         die_count = int(die_count)
 
-    die_type = int(die_code.split('d')[1])
+    die_type = int(die_type)
 
     return die_count, die_type
 
 
+@_lru_cache(maxsize=1024)
 def parse_roll_line(roll_line):
     bonus = 0
     dice = []
@@ -61,4 +704,4 @@ def parse_roll_line(roll_line):
                 die_count, die_type = parse_dice_code(chunk)
                 dice.append((op_type, die_count, die_type))
 
-    return dice, bonus
+    return RollExpression(dice, bonus)
@@ -1,65 +1,292 @@
 #!/usr/bin/env python
 
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import argparse
 import numpy
 import sys
-import fileinput
-
-parser = argparse.ArgumentParser(
-    description='Simple histogram generator to quickly check the distributions of dice rolls.')
-parser.add_argument(
-    'number_source',
-    help='Source for numbers to draw the histogram from. Can be a file or stdin. Intended use is piping to this, ex.: ./roll_dice 4d6 -b 3 -c 1000 | ./draw_histogram',
-    nargs="?",
-    type=argparse.FileType('r'),
-    default=sys.stdin)
-args = parser.parse_args()
-
-number_columns = []
-for line in fileinput.input():
-    numbers = []
-    for number in line.split():
-        numbers.append(int(number))
-
-    number_columns.append(numbers)
-
-numbers = numpy.asarray(number_columns)
-
-if numbers.shape[0] < numbers.shape[1]:
-    numbers = numpy.transpose(numbers)
-
-x_bins = range(numpy.amin(numbers), numpy.amax(numbers) + 2)
-x_bin_offsets = [x + 0.5 for x in x_bins]
-
-fig, ax = plt.subplots()
-
-ax.xaxis.set_major_formatter(ticker.NullFormatter())
-ax.xaxis.set_minor_locator(ticker.FixedLocator(x_bin_offsets))
-ax.xaxis.set_minor_formatter(ticker.FixedFormatter(x_bins))
-
-alpha = 1.0
-if numbers.shape[1] > 1:
-    alpha = 0.5
-n, bins, patches = plt.hist(
-    numbers, bins=x_bins, normed=True, alpha=alpha, histtype='stepfilled')
-
-#ax.xaxis.grid(True, linestyle = '-', which = 'major')
-plt.xticks(x_bins)
-ax.xaxis.grid(True, linestyle='-', which='major')
-ax.yaxis.grid(True, linestyle='--')
-
-plt.xlabel('Result')
-plt.ylabel('Probability')
-plt.title('Histograms of rolls')
-
-legend_labels = []
-for i in range(numbers.shape[1]):
-    legend_labels.append('$avg = ' +
-                         str(numpy.mean(numbers[:, i])) +
-                         '$, $std = ' +
-                         str(numpy.std(numbers[:, i])) +
-                         '$')
-plt.legend(legend_labels, loc='upper right', shadow=True)
-plt.show()
+import io
+import itertools
+import struct
+import time
+if __package__:
+    from . import dice_util as du
+else:
+    import dice_util as du
+
+NPY_MAGIC = b'\x93NUMPY'
+RAW_DTYPE = '<i4'
+CHUNK_ROWS = 65536
+CHUNK_VALUES = 1 << 20
+standard_input = getattr(sys.stdin, 'buffer', sys.stdin)
+
+
+class HistogramAccumulator(object):
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.sample_count = 0
+        self.mean = 0.0
+        self.squared_deviations = 0.0
+
+    def add(self, values):
+        values = numpy.asarray(values, dtype=numpy.int64)
+        if len(values) == 0:
+            return
+
+        self.counts, self.offset = du.widen_counts(
+            self.counts, self.offset, int(values.min()), int(values.max()))
+        self.counts += numpy.bincount(
+            values - self.offset, minlength=len(self.counts))
+
+        # Chan et al. merge of the running Welford statistics with the chunk.
+        chunk_count = len(values)
+        chunk_mean = values.mean()
+        chunk_squared_deviations = ((values - chunk_mean) ** 2).sum()
+
+        sample_count = self.sample_count + chunk_count
+        delta = chunk_mean - self.mean
+        self.mean += delta * chunk_count / sample_count
+        self.squared_deviations += chunk_squared_deviations + \
+            delta * delta * self.sample_count * chunk_count / sample_count
+        self.sample_count = sample_count
+
+    def minimum(self):
+        return self.offset
+
+    def maximum(self):
+        return self.offset + len(self.counts) - 1
+
+    def std(self):
+        return (self.squared_deviations / self.sample_count) ** 0.5
+
+    def probabilities(self, low, high):
+        probabilities = numpy.zeros(high - low + 1)
+        probabilities[self.offset - low:self.offset - low + len(self.counts)] = \
+            self.counts / float(self.sample_count)
+        return probabilities
+
+
+def array_chunks(numbers):
+    if numbers.shape[0] < numbers.shape[1]:
+        for row in range(numbers.shape[0]):
+            for start in range(0, numbers.shape[1], CHUNK_VALUES):
+                yield row, numbers[row:row + 1, start:start + CHUNK_VALUES].T
+    else:
+        for start in range(0, numbers.shape[0], CHUNK_ROWS):
+            yield 0, numbers[start:start + CHUNK_ROWS]
+
+
+def binary_blocks(data, stream, dtype, row_length):
+    row_bytes = numpy.dtype(dtype).itemsize * row_length
+    chunk_rows = max(1, CHUNK_VALUES // row_length)
+    while True:
+        more = stream.read(row_bytes * chunk_rows)
+        data = data + more
+
+        usable = len(data) - len(data) % row_bytes
+        if usable > 0:
+            yield numpy.frombuffer(
+                data, dtype=dtype, count=usable // row_bytes * row_length
+            ).reshape(-1, row_length)
+            data = data[usable:]
+
+        if len(more) == 0:
+            break
+
+
+def npy_stream_chunks(head, stream):
+    if head[6:7] == b'\x01':
+        header_end = 10 + struct.unpack('<H', head[8:10])[0]
+    else:
+        header_end = 12 + struct.unpack('<I', head[8:12])[0]
+    if len(head) < header_end:
+        head = head + stream.read(header_end - len(head))
+
+    header = io.BytesIO(head[:header_end])
+    version = numpy.lib.format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = \
+            numpy.lib.format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = \
+            numpy.lib.format.read_array_header_2_0(header)
+
+    # Fortran order stores the transpose, so its rows are the columns.
+    stored_shape = shape[::-1] if fortran_order else shape
+    rows_are_columns = fortran_order != (shape[0] < shape[1])
+
+    if not rows_are_columns:
+        for block in binary_blocks(
+                head[header_end:], stream, dtype, stored_shape[1]):
+            yield 0, block
+        return
+
+    # Each stored row is a whole column, so split the flat value stream at
+    # row boundaries instead of buffering entire rows.
+    position = 0
+    for values in binary_blocks(head[header_end:], stream, dtype, 1):
+        while len(values) > 0:
+            row, column = divmod(position, stored_shape[1])
+            taken = min(len(values), stored_shape[1] - column)
+            yield row, values[:taken]
+            values = values[taken:]
+            position += taken
+
+
+def text_chunks(lines):
+    first_chunk = True
+    while True:
+        chunk_lines = list(itertools.islice(lines, CHUNK_ROWS))
+        if len(chunk_lines) == 0:
+            break
+
+        rows = [line for line in chunk_lines if len(line.split()) > 0]
+        if len(rows) > 0:
+            numbers = numpy.fromstring(
+                b" ".join(rows).decode(), dtype=numpy.int64, sep=' ')
+            numbers = numbers.reshape(len(rows), -1)
+
+            # The whole input fits in the first chunk, so the original
+            # orientation check can be applied to all of it.
+            if first_chunk and len(chunk_lines) < CHUNK_ROWS and \
+                    numbers.shape[0] < numbers.shape[1]:
+                yield 0, numbers.T
+            else:
+                yield 0, numbers
+
+        first_chunk = False
+
+
+def read_chunks(number_source, file_format='auto', columns=1):
+    file_name = None
+    if number_source is not standard_input:
+        file_name = number_source.name
+
+    if file_format == 'raw':
+        if file_name is not None:
+            numbers = numpy.memmap(file_name, dtype=RAW_DTYPE, mode='r')
+            return array_chunks(numbers.reshape(-1, columns))
+
+        return ((0, block) for block in binary_blocks(
+            b"", number_source, RAW_DTYPE, columns))
+
+    # Only npy input describes itself, so it is the only format told apart
+    # from text without being asked for.
+    head = number_source.read(len(NPY_MAGIC))
+    if file_format == 'npy' or \
+            (file_format == 'auto' and head.startswith(NPY_MAGIC)):
+        if file_name is not None:
+            return array_chunks(numpy.load(file_name, mmap_mode='r'))
+
+        return npy_stream_chunks(
+            head + number_source.read(4096), number_source)
+    else:
+        head_lines = (head + number_source.readline()).splitlines()
+        return text_chunks(itertools.chain(head_lines, number_source))
+
+
+def draw_histograms(ax, accumulators):
+    import matplotlib.ticker as ticker
+
+    ax.cla()
+
+    low = min(accumulator.minimum() for accumulator in accumulators)
+    high = max(accumulator.maximum() for accumulator in accumulators)
+    x_bins = range(low, high + 2)
+    x_bin_offsets = [x + 0.5 for x in x_bins]
+
+    ax.xaxis.set_major_formatter(ticker.NullFormatter())
+    ax.xaxis.set_minor_locator(ticker.FixedLocator(x_bin_offsets))
+    ax.xaxis.set_minor_formatter(ticker.FixedFormatter(x_bins))
+
+    alpha = 1.0
+    if len(accumulators) > 1:
+        alpha = 0.5
+    for accumulator in accumulators:
+        ax.hist(
+            range(low, high + 1),
+            bins=x_bins,
+            weights=accumulator.probabilities(low, high),
+            alpha=alpha,
+            histtype='stepfilled')
+
+    ax.set_xticks(x_bins)
+    ax.xaxis.grid(True, linestyle='-', which='major')
+    ax.yaxis.grid(True, linestyle='--')
+
+    ax.set_xlabel('Result')
+    ax.set_ylabel('Probability')
+    ax.set_title('Histograms of rolls')
+
+    legend_labels = []
+    for accumulator in accumulators:
+        legend_labels.append('$avg = ' +
+                             str(float(accumulator.mean)) +
+                             '$, $std = ' +
+                             str(float(accumulator.std())) +
+                             '$')
+    ax.legend(legend_labels, loc='upper right', shadow=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simple histogram generator to quickly check the distributions of dice rolls.')
+    parser.add_argument(
+        'number_source',
+        help='Source for numbers to draw the histogram from. Can be a file or stdin. Intended use is piping to this, ex.: ./roll_dice 4d6 -b 3 -c 1000 | ./draw_histogram. Text and .npy input (roll_dice -f npy) are detected automatically, raw int32 input (roll_dice -f raw) needs --format raw',
+        nargs="?",
+        type=argparse.FileType('rb'),
+        default=standard_input)
+    parser.add_argument(
+        '-f',
+        '--format',
+        help='input format, auto tells .npy from text by its header, raw is little-endian int32 rows of --columns values',
+        choices=['auto', 'text', 'npy', 'raw'],
+        default='auto')
+    parser.add_argument(
+        '--columns',
+        help='number of columns in raw int32 input',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '-r',
+        '--refresh',
+        help='redraw the histogram every given number of seconds while input is still being read',
+        type=float)
+    args = parser.parse_args()
+
+    # Without live redraws the plotting backend is only needed once all of
+    # the input has been read.
+    if args.refresh is not None:
+        import matplotlib.pyplot as plt
+        plt.ion()
+        fig, ax = plt.subplots()
+
+    accumulators = []
+    last_draw = time.time()
+    for first_column, numbers in read_chunks(
+            args.number_source, args.format, args.columns):
+        while len(accumulators) < first_column + numbers.shape[1]:
+            accumulators.append(HistogramAccumulator())
+
+        for i in range(numbers.shape[1]):
+            accumulators[first_column + i].add(numbers[:, i])
+
+        if args.refresh is not None and \
+                time.time() - last_draw >= args.refresh:
+            draw_histograms(ax, accumulators)
+            plt.pause(0.001)
+            last_draw = time.time()
+
+    if args.refresh is not None:
+        plt.ioff()
+    else:
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots()
+
+    draw_histograms(ax, accumulators)
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy
+if __package__:
+    from . import dice_util as du
+else:
+    import dice_util as du
+
+COMBATANT_DTYPE = numpy.dtype([
+    ('team', numpy.int32),
+    ('hp', numpy.int32),
+    ('ac', numpy.int32),
+    ('initiative', numpy.int32)])
+
+
+class EncounterArgumentException(Exception):
+    pass
+
+
+class Attack(object):
+    __slots__ = ('attack_die', 'attack_bonus', 'damage', 'crit_damage')
+
+    def __init__(self, attack_roll, damage_roll):
+        attack = du.parse_roll_line(attack_roll)
+        if len(attack.dice) == 0:
+            raise EncounterArgumentException(
+                "Attack roll {} has no die to roll.".format(attack_roll))
+
+        self.attack_die = du.RollExpression(attack.dice[:1], 0)
+        self.attack_bonus = attack.bonus
+        self.damage = du.parse_roll_line(damage_roll)
+        self.crit_damage = self.damage.critical()
+
+
+class Encounter(object):
+
+    def __init__(self, encounter_file):
+        self.names = []
+        self.teams = []
+        self.attacks = []
+        combatants = []
+
+        for line in encounter_file:
+            if len(line.strip()) == 0 or line.strip().startswith('#'):
+                continue
+
+            if ':' not in line:
+                raise EncounterArgumentException(
+                    "\"{}\" is not a \"name: team, HP, AC, initiative bonus, "
+                    "attacks\" line.".format(line.strip()))
+            name, statement = line.split(':', 1)
+            count = 1
+            if '*' in name:
+                try:
+                    count = int(name[:name.find('*')])
+                except ValueError:
+                    raise EncounterArgumentException(
+                        "\"{}\" needs a whole number before the *.".format(
+                            name.strip()))
+                name = name[name.find('*') + 1:]
+            name = name.strip()
+
+            fields = [field.strip() for field in statement.split(',')]
+            if len(fields) < 5:
+                raise EncounterArgumentException(
+                    "{} needs a team, HP, AC, initiative bonus and at least "
+                    "one attack.".format(name))
+
+            if fields[0] not in self.teams:
+                self.teams.append(fields[0])
+            team = self.teams.index(fields[0])
+
+            try:
+                hp, ac, initiative = [int(field) for field in fields[1:4]]
+            except ValueError:
+                raise EncounterArgumentException(
+                    "{} needs whole numbers for HP, AC and initiative "
+                    "bonus.".format(name))
+
+            attacks = []
+            for attack_field in fields[4:]:
+                if len(attack_field.split()) != 2:
+                    raise EncounterArgumentException(
+                        "{} has an attack \"{}\" that is not an attack roll "
+                        "and a damage roll, ex: 1d20+4 1d6+2.".format(
+                            name, attack_field))
+                attack_roll, damage_roll = attack_field.split()
+                try:
+                    attacks.append(Attack(attack_roll, damage_roll))
+                except ValueError:
+                    raise EncounterArgumentException(
+                        "{} has an attack \"{}\" with an invalid roll.".format(
+                            name, attack_field))
+
+            for i in range(count):
+                if count > 1:
+                    self.names.append("{} {}".format(name, i + 1))
+                else:
+                    self.names.append(name)
+                self.attacks.append(attacks)
+                combatants.append((team, hp, ac, initiative))
+
+        if len(self.teams) < 2:
+            raise EncounterArgumentException(
+                "An encounter needs at least two teams.")
+
+        self.combatants = numpy.array(combatants, dtype=COMBATANT_DTYPE)
+
+    def simulate(self, replicates, max_rounds):
+        combatant_count = len(self.combatants)
+        teams = self.combatants['team']
+        hp = numpy.tile(self.combatants['hp'], (replicates, 1))
+        ac = self.combatants['ac']
+
+        # Every replicate gets its own initiative order; the random fraction
+        # breaks ties.
+        source = du.random_source()
+        initiative = source.integers(
+            1, 21, size=(replicates, combatant_count)) + \
+            self.combatants['initiative'] + \
+            source.random_sample((replicates, combatant_count))
+        turn_order = numpy.argsort(-initiative, axis=1)
+
+        down_round = numpy.zeros((replicates, combatant_count), dtype=int)
+        finished_round = numpy.zeros(replicates, dtype=int)
+        winners = numpy.full(replicates, -1, dtype=int)
+        running = numpy.ones(replicates, dtype=bool)
+
+        for round_number in range(1, max_rounds + 1):
+            for turn in range(combatant_count):
+                for actor in range(combatant_count):
+                    rows = numpy.flatnonzero(
+                        running & (turn_order[:, turn] == actor) &
+                        (hp[:, actor] > 0))
+                    if len(rows) > 0:
+                        self.take_turn(actor, rows, hp, ac, teams)
+
+                newly_down = (hp <= 0) & (down_round == 0)
+                down_round[newly_down] = round_number
+                running = self.update_finished(
+                    hp, teams, running, round_number, finished_round,
+                    winners)
+
+            if not running.any():
+                break
+
+        return winners, finished_round, down_round
+
+    def take_turn(self, actor, rows, hp, ac, teams):
+        enemies = teams != teams[actor]
+        for attack in self.attacks[actor]:
+            candidates = (hp[rows] > 0) & enemies
+            has_target = candidates.any(axis=1)
+            rows = rows[has_target]
+            if len(rows) == 0:
+                return
+
+            target_keys = du.random_source().random_sample(
+                (len(rows), len(teams))) * candidates[has_target]
+            targets = numpy.argmax(target_keys, axis=1)
+
+            n = len(rows)
+            natural_roll = attack.attack_die.roll_batch(n)
+            critical = natural_roll == 20
+            hit = critical | \
+                (natural_roll + attack.attack_bonus >= ac[targets])
+            normal_hit = hit & ~critical
+
+            damage = numpy.zeros(n, dtype=numpy.int64)
+            damage[normal_hit] = attack.damage.roll_totals(
+                int(normal_hit.sum()))
+            damage[critical] = attack.crit_damage.roll_totals(
+                int(critical.sum()))
+            hp[rows, targets] -= numpy.maximum(damage, 0).astype(hp.dtype)
+
+    def update_finished(self, hp, teams, running, round_number,
+                        finished_round, winners):
+        team_alive = numpy.zeros((len(hp), len(self.teams)), dtype=bool)
+        for team in range(len(self.teams)):
+            team_alive[:, team] = (hp[:, teams == team] > 0).any(axis=1)
+
+        finished = running & (team_alive.sum(axis=1) <= 1)
+        finished_round[finished] = round_number
+        winners[finished] = numpy.where(
+            team_alive[finished].any(axis=1),
+            numpy.argmax(team_alive[finished], axis=1),
+            -1)
+
+        return running & ~finished
+
+
+def print_report(encounter, replicates, winners, finished_round, down_round):
+    print("Encounters:      {}".format(replicates))
+    for team, team_name in enumerate(encounter.teams):
+        print("{:<17}{:.4f}% wins".format(
+            team_name + ":", 100.0 * (winners == team).mean()))
+
+    unfinished = finished_round == 0
+    if unfinished.any():
+        print("{:<17}{:.4f}%".format(
+            "Round limit:", 100.0 * unfinished.mean()))
+
+    if not unfinished.all():
+        rounds = du.RollDistribution(
+            0, numpy.bincount(finished_round[~unfinished]))
+        print("Rounds:          avg = {:.4f}, std = {:.4f}".format(
+            rounds.mean(), rounds.std()))
+        print("Percentiles (5/25/50/75/95): {}".format(
+            " / ".join(str(rounds.percentile(q))
+                       for q in (5, 25, 50, 75, 95))))
+
+    print("----------------------------")
+    name_length = max(10, max(len(name) for name in encounter.names) + 1)
+    print("{} | Survives  | Avg round down".format(
+        "Combatant".ljust(name_length)))
+    for i, name in enumerate(encounter.names):
+        went_down = down_round[:, i] > 0
+        average_round = "-"
+        if went_down.any():
+            average_round = "{:.4f}".format(down_round[went_down, i].mean())
+        print("{} | {:>8.4f}% | {}".format(
+            name.ljust(name_length),
+            100.0 * (1.0 - went_down.mean()),
+            average_round))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Multi-round encounter simulator for D&D 5th edition.')
+    parser.add_argument(
+        'encounter_file',
+        help='File listing one combatant per line, ex: "3 * Goblin: monsters, 7, 15, +2, 1d20+4 1d6+2" (team, HP, AC, initiative bonus, then one "attack_roll damage_roll" pair per attack)',
+        type=argparse.FileType('r'))
+    parser.add_argument(
+        '-c',
+        help='number of times to run the encounter',
+        type=int)
+    parser.add_argument(
+        '--max_rounds',
+        help='stop an encounter after this many rounds',
+        type=int,
+        default=100)
+    parser.add_argument(
+        '--seed',
+        help='seed for the simulation',
+        type=int)
+    parser.add_argument(
+        '--rng',
+        help='NumPy bit generator for the simulation',
+        choices=sorted(du.BIT_GENERATORS),
+        default='pcg64')
+
+    args = parser.parse_args()
+
+    repeats = 1
+    if args.c is not None:
+        if args.c >= 1:
+            repeats = args.c
+
+    try:
+        du.seed_random_source(args.seed, args.rng)
+
+        encounter = Encounter(args.encounter_file)
+        winners, finished_round, down_round = encounter.simulate(
+            repeats, args.max_rounds)
+        print_report(encounter, repeats, winners, finished_round, down_round)
+
+    except EncounterArgumentException as ex:
+        print(ex.args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,299 @@
 #!/usr/bin/env python2
 
-import random
+import ast
+import hashlib
+import mmap
+import multiprocessing
+import os
+import struct
 import sys
+import timeit
 from collections import OrderedDict
 import argparse
+import json
+
+if __package__:
+    from . import dice_util as du
+else:
+    import dice_util as du
+
+
+LINE_INDEX_MAGIC = b'DNDLIDX1'
+LINE_INDEX_HEADER = struct.Struct('<8sQdQ')
+LINE_OFFSET = struct.Struct('<Q')
+
+MAX_SAMPLE_ATTEMPTS = 100
+COMPILED_TEMPLATE_MAGIC = b'DNDTPL2'
+
+line_index_threshold = 64 * 1024 * 1024
+word_list_cache = {}
+word_list_values = {}
+word_list_epoch = 0
+profile_counters = None
+PROFILE_COUNTERS = ('lookups', 'file_loads', 'retries')
+
+
+def count_profile_event(counter, amount=1):
+    if profile_counters is not None:
+        profile_counters[counter] += amount
+
+
+def line_index_is_current(index_name, source_stat):
+    try:
+        with open(index_name, 'rb') as index_file:
+            header = index_file.read(LINE_INDEX_HEADER.size)
+            index_size = os.fstat(index_file.fileno()).st_size
+    except (IOError, OSError):
+        return False
+
+    if len(header) < LINE_INDEX_HEADER.size:
+        return False
+
+    magic, size, mtime, count = LINE_INDEX_HEADER.unpack(header)
+    return (magic == LINE_INDEX_MAGIC and
+            size == source_stat.st_size and
+            mtime == source_stat.st_mtime and
+            index_size == LINE_INDEX_HEADER.size + count * LINE_OFFSET.size)
+
+
+def line_index_names(file_name):
+    yield file_name + ".idx"
+
+    # Lists in read-only directories keep their index in the user cache.
+    cache_directory = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'),
+        'dndhelper')
+    key = file_name
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    yield os.path.join(
+        cache_directory, hashlib.sha1(key).hexdigest() + ".idx")
+
+
+def build_line_index(file_name, index_name, source_stat):
+    index_directory = os.path.dirname(index_name)
+    if not os.path.isdir(index_directory):
+        os.makedirs(index_directory)
+
+    temp_name = "{}.{}.tmp".format(index_name, os.getpid())
+    count = 0
+    try:
+        with open(file_name, 'rb') as source_file:
+            with open(temp_name, 'wb') as index_file:
+                index_file.write(b'\0' * LINE_INDEX_HEADER.size)
+
+                offsets = []
+                offset = 0
+                for line in source_file:
+                    if len(line) >= 2:
+                        offsets.append(offset)
+                    offset += len(line)
+
+                    if len(offsets) == 65536:
+                        index_file.write(struct.pack(
+                            '<{}Q'.format(len(offsets)), *offsets))
+                        count += len(offsets)
+                        offsets = []
+
+                index_file.write(struct.pack(
+                    '<{}Q'.format(len(offsets)), *offsets))
+                count += len(offsets)
+
+                index_file.seek(0)
+                index_file.write(LINE_INDEX_HEADER.pack(
+                    LINE_INDEX_MAGIC,
+                    source_stat.st_size,
+                    source_stat.st_mtime,
+                    count))
+
+        os.rename(temp_name, index_name)
+    finally:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+def find_line_index(file_name, source_stat):
+    for index_name in line_index_names(file_name):
+        if line_index_is_current(index_name, source_stat):
+            return index_name
+
+        try:
+            build_line_index(file_name, index_name, source_stat)
+            return index_name
+        except (IOError, OSError):
+            pass
+
+    return None
+
+
+class IndexedWordList(object):
+
+    def __init__(self, file_name, index_name):
+        self.source_file = open(file_name, 'rb')
+        self.index_file = open(index_name, 'rb')
+        self.source = mmap.mmap(
+            self.source_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = mmap.mmap(
+            self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = LINE_INDEX_HEADER.unpack_from(self.index)[3]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("word list index out of range")
+
+        start = LINE_OFFSET.unpack_from(
+            self.index, LINE_INDEX_HEADER.size + i * LINE_OFFSET.size)[0]
+        end = self.source.find(b'\n', start)
+        if end == -1:
+            end = len(self.source)
+
+        line = self.source[start:end].strip()
+        if not isinstance(line, str):
+            line = line.decode('utf-8')
+        return line
+
+    def close(self):
+        self.source.close()
+        self.index.close()
+        self.source_file.close()
+        self.index_file.close()
+
+
+def refresh_word_lists():
+    global word_list_epoch
+
+    word_list_epoch += 1
+
+
+def load_word_list(file_name):
+    count_profile_event('lookups')
+
+    # Word lists are stat'ed once per refresh_word_lists() call, not once
+    # per draw.
+    cached = word_list_cache.get(file_name)
+    if cached is not None and cached[2] == word_list_epoch:
+        return cached[1]
+
+    source_stat = os.stat(file_name)
+    mtime = source_stat.st_mtime
+    if cached is None or cached[0] != mtime:
+        count_profile_event('file_loads')
+        if cached is not None and isinstance(cached[1], IndexedWordList):
+            cached[1].close()
+
+        index_name = None
+        if 0 <= line_index_threshold <= source_stat.st_size and \
+                source_stat.st_size > 0:
+            index_name = find_line_index(file_name, source_stat)
+
+        # Without anywhere to write an index the list is read into memory.
+        if index_name is not None:
+            gen_list = IndexedWordList(file_name, index_name)
+        else:
+            with open(file_name, 'r') as gen_file:
+                gen_list = tuple(line.strip() for line in gen_file
+                                 if len(line) >= 2)
+    else:
+        gen_list = cached[1]
+    word_list_cache[file_name] = (mtime, gen_list, word_list_epoch)
+
+    return gen_list
+
+
+def sample_indices(population_size, k):
+    # Floyd's algorithm: k distinct indices from exactly k random draws.
+    source = du.random_source()
+    chosen = set()
+    indices = []
+    for j in range(population_size - k, population_size):
+        i = source.randint(0, j)
+        if i in chosen:
+            i = j
+        chosen.add(i)
+        indices.append(i)
+
+    source.shuffle(indices)
+    return indices
+
+
+def sample_index_rows(n, population_size, k):
+    import numpy
+
+    # Floyd's algorithm on every row at once: k draws per row, never a
+    # redraw, however close k is to the population size.
+    source = du.random_source()
+    indices = numpy.empty((n, k), dtype=numpy.int64)
+    for t, j in enumerate(range(population_size - k, population_size)):
+        draws = source.integers(0, j + 1, size=n)
+        if t > 0:
+            taken = (indices[:, :t] == draws.reshape(-1, 1)).any(axis=1)
+            draws[taken] = j
+        indices[:, t] = draws
+
+    # Floyd's picks come out in a biased order, so shuffle every row.
+    order = numpy.argsort(source.random_sample((n, k)), axis=1)
+    return numpy.take_along_axis(indices, order, axis=1)
+
+
+def gather_values(file_name, gen_list, rows):
+    import numpy
+
+    # Equal lines get equal ids, so repeated values show up as equal
+    # neighbours once each row of ids is sorted.
+    if isinstance(gen_list, IndexedWordList):
+        # Indexed lists are too big to read whole, so only the lines that
+        # were drawn are read and numbered.
+        lines, inverse = numpy.unique(rows, return_inverse=True)
+        inverse = inverse.reshape(rows.shape)
+        values = numpy.array([gen_list[int(j)] for j in lines], dtype=object)
+        ids = {}
+        line_ids = numpy.array(
+            [ids.setdefault(value, len(ids)) for value in values],
+            dtype=numpy.int64)
+        return values[inverse], line_ids[inverse]
+
+    cached = word_list_values.get(file_name)
+    if cached is None or cached[0] is not gen_list:
+        ids = {}
+        line_ids = numpy.array(
+            [ids.setdefault(line, len(ids)) for line in gen_list],
+            dtype=numpy.int64)
+        cached = (gen_list, numpy.array(gen_list, dtype=object), line_ids)
+        word_list_values[file_name] = cached
+    return cached[1][rows], cached[2][rows]
+
+
+def object_column(n, value=None):
+    import numpy
+
+    column = numpy.empty(n, dtype=object)
+    column.fill(value)
+    return column
+
+
+def select_rows(columns, rows):
+    return dict((name, column[rows]) for name, column in columns.items())
+
+
+def generate_choice_batch(choices, choice_indices, columns):
+    result = object_column(len(choice_indices))
+    for i, choice in enumerate(choices):
+        rows = choice_indices == i
+        if rows.any():
+            result[rows] = choice.generate_batch(
+                int(rows.sum()), select_rows(columns, rows))
+
+    return result
+
+
+class GenerationException(Exception):
+    pass
 
 
 class Generator(object):
@@ -13,28 +303,48 @@ class Generator(object):
         self.content_map = content_map
 
     def generate_sample(self):
-        raise NotImplemented()
+        raise NotImplementedError()
+
+    def generate_batch(self, n, columns):
+        raise NotImplementedError()
+
+    def dependencies(self):
+        return set()
+
+    def to_data(self):
+        raise NotImplementedError()
 
 
 class UniformFileGenerator(Generator):
 
     def __init__(self, name, content_map, file_name):
-        self.file_name = file_name
+        self.template_file_name = file_name
+        self.file_name = os.path.abspath(file_name)
 
         super(UniformFileGenerator, self).__init__(name, content_map)
 
     def generate_sample(self):
-        gen_file = open(self.file_name, 'r')
-        gen_list = []
-        for line in gen_file.readlines():
-            if len(line) >= 2:
-                gen_list.append(line.strip())
-
-        choice = random.choice(gen_list)
+        choice = du.random_source().choice(load_word_list(self.file_name))
         # if isinstance(choice, str):
         #   choice = choice.decode('utf-8')
         return choice
 
+    def generate_batch(self, n, columns):
+        import numpy
+
+        gen_list = load_word_list(self.file_name)
+        indices = du.random_source().integers(0, len(gen_list), size=n)
+        result = object_column(n)
+        if isinstance(gen_list, tuple):
+            result[:] = numpy.array(gen_list, dtype=object)[indices]
+        else:
+            result[:] = [gen_list[i] for i in indices]
+
+        return result
+
+    def to_data(self):
+        return ('file', self.name, self.template_file_name)
+
 
 class ValueGenerator(Generator):
 
@@ -46,11 +356,46 @@ class ValueGenerator(Generator):
     def generate_sample(self):
         return self.value
 
+    def generate_batch(self, n, columns):
+        return object_column(n, self.value)
+
+    def to_data(self):
+        return ('value', self.name, self.value)
+
+
+class AliasTable(object):
+
+    def __init__(self, weights):
+        self.probabilities, self.aliases = du.alias_table(weights)
+
+        self.probability_array = None
+        self.alias_array = None
+
+    def sample(self):
+        source = du.random_source()
+        i = source.randrange(len(self.probabilities))
+        if source.random() < self.probabilities[i]:
+            return i
+        return self.aliases[i]
+
+    def sample_batch(self, k):
+        import numpy
+
+        if self.probability_array is None:
+            self.probability_array = numpy.asarray(self.probabilities)
+            self.alias_array = numpy.asarray(self.aliases)
+
+        source = du.random_source()
+        columns = source.integers(0, len(self.probabilities), size=k)
+        keep = source.random_sample(k) < self.probability_array[columns]
+        return numpy.where(keep, columns, self.alias_array[columns])
+
 
 class ProbabilityGenerator(Generator):
 
     def __init__(self, name, content_map, choices):
         self.choices = choices
+        self.alias_table = AliasTable([w for c, w in choices])
 
         super(ProbabilityGenerator, self).__init__(name, content_map)
 
@@ -58,14 +403,29 @@ class ProbabilityGenerator(Generator):
         return self.weighted_choice(self.choices).generate_sample()
 
     def weighted_choice(self, choices):
-        total = sum(w for c, w in choices)
-        r = random.uniform(0, total)
-        upto = 0
-        for c, w in choices:
-            if upto + w > r:
-                return c
-            upto += w
-        assert False, "Shouldn't get here"
+        if choices is self.choices:
+            return choices[self.alias_table.sample()][0]
+
+        return choices[AliasTable([w for c, w in choices]).sample()][0]
+
+    def dependencies(self):
+        return set().union(*[c.dependencies() for c, w in self.choices])
+
+    def generate_batch(self, n, columns):
+        return generate_choice_batch(
+            [c for c, w in self.choices],
+            self.weighted_choice_indices(n),
+            columns)
+
+    def weighted_choice_indices(self, k):
+        return self.alias_table.sample_batch(k)
+
+    def weighted_choices(self, k):
+        return [self.choices[i][0] for i in self.weighted_choice_indices(k)]
+
+    def to_data(self):
+        return ('probability', self.name,
+                tuple((c.to_data(), w) for c, w in self.choices))
 
 
 class UniformProbabilityGenerator(Generator):
@@ -76,7 +436,20 @@ class UniformProbabilityGenerator(Generator):
         super(UniformProbabilityGenerator, self).__init__(name, content_map)
 
     def generate_sample(self):
-        return random.choice(self.choices).generate_sample()
+        return du.random_source().choice(self.choices).generate_sample()
+
+    def generate_batch(self, n, columns):
+        return generate_choice_batch(
+            self.choices,
+            du.random_source().integers(0, len(self.choices), size=n),
+            columns)
+
+    def dependencies(self):
+        return set().union(*[c.dependencies() for c in self.choices])
+
+    def to_data(self):
+        return ('uniform', self.name,
+                tuple(c.to_data() for c in self.choices))
 
 
 class DependanceGenerator(Generator):
@@ -85,9 +458,14 @@ class DependanceGenerator(Generator):
         self.choices = choices
         self.dependancy_name = dependancy_name
 
-        for i, choice in enumerate(self.choices):
-            if choice[1] == "ANY":
-                self.choices.append(self.choices.pop(i))
+        self.choice_map = {}
+        self.any_choice = None
+        for generator, condition in self.choices:
+            if condition == "ANY":
+                if self.any_choice is None:
+                    self.any_choice = generator
+            elif condition not in self.choice_map:
+                self.choice_map[condition] = generator
 
         super(DependanceGenerator, self).__init__(name, content_map)
 
@@ -95,12 +473,45 @@ class DependanceGenerator(Generator):
         if self.dependancy_name not in self.content_map:
             return None
 
-        for choice in self.choices:
-            if choice[1] == self.content_map[
-                    self.dependancy_name] or choice[1] == "ANY":
-                return choice[0].generate_sample()
+        choice = self.choice_map.get(
+            self.content_map[self.dependancy_name], self.any_choice)
+        if choice is None:
+            return None
 
-        return None
+        return choice.generate_sample()
+
+    def generate_batch(self, n, columns):
+        import numpy
+
+        result = object_column(n)
+        if self.dependancy_name not in columns:
+            return result
+
+        values = columns[self.dependancy_name]
+        matched = numpy.zeros(n, dtype=bool)
+        for condition, choice in self.choice_map.items():
+            rows = values == condition
+            if rows.any():
+                result[rows] = choice.generate_batch(
+                    int(rows.sum()), select_rows(columns, rows))
+                matched |= rows
+
+        if self.any_choice is not None and not matched.all():
+            rows = ~matched
+            result[rows] = self.any_choice.generate_batch(
+                int(rows.sum()), select_rows(columns, rows))
+
+        return result
+
+    def dependencies(self):
+        return set([self.dependancy_name]).union(
+            *[c.dependencies() for c, condition in self.choices])
+
+    def to_data(self):
+        return ('dependance', self.name,
+                tuple((c.to_data(), condition)
+                      for c, condition in self.choices),
+                self.dependancy_name)
 
 
 class MultipleWithoutReplacementGenerator(Generator):
@@ -115,13 +526,99 @@ class MultipleWithoutReplacementGenerator(Generator):
             name,
             content_map)
 
+    def dependencies(self):
+        return self.gen_provider.dependencies()
+
+    def to_data(self):
+        return ('multiple', self.name, self.gen_count,
+                self.gen_provider.to_data())
+
+    def check_word_list(self, gen_list):
+        # Fewer lines than values can never be drawn without repeats.
+        if len(gen_list) < self.gen_count:
+            raise GenerationException(
+                "Could not generate {} different values for {} from {} lines "
+                "of {}.".format(self.gen_count, self.name, len(gen_list),
+                                self.gen_provider.template_file_name))
+
     def generate_sample(self):
+        if isinstance(self.gen_provider, UniformFileGenerator):
+            gen_list = load_word_list(self.gen_provider.file_name)
+            self.check_word_list(gen_list)
+            samples = [gen_list[i] for i in sample_indices(
+                len(gen_list), self.gen_count)]
+            if len(set(samples)) == len(samples):
+                return tuple(samples)
+            count_profile_event('retries')
+
         samples = []
-        while len(samples) < self.gen_count:
-            samples.append(self.gen_provider.generate_sample())
-            samples = list(set(samples))
+        seen = set()
+        for i in range(self.gen_count * MAX_SAMPLE_ATTEMPTS):
+            sample = self.gen_provider.generate_sample()
+            if sample not in seen:
+                seen.add(sample)
+                samples.append(sample)
+                if len(samples) == self.gen_count:
+                    return tuple(samples)
+            else:
+                count_profile_event('retries')
+
+        raise GenerationException(
+            "Could not generate {} different values for {} in {} tries.".format(
+                self.gen_count, self.name,
+                self.gen_count * MAX_SAMPLE_ATTEMPTS))
+
+    def generate_batch(self, n, columns):
+        import numpy
+
+        result = object_column(n)
+        samples = [[] for i in range(n)]
+        seen = [set() for i in range(n)]
+        pending = numpy.arange(n)
+        if isinstance(self.gen_provider, UniformFileGenerator):
+            gen_list = load_word_list(self.gen_provider.file_name)
+            self.check_word_list(gen_list)
+            values, ids = gather_values(
+                self.gen_provider.file_name, gen_list,
+                sample_index_rows(n, len(gen_list), self.gen_count))
+            ids.sort(axis=1)
+            repeated = (ids[:, 1:] == ids[:, :-1]).any(axis=1)
+            distinct = numpy.flatnonzero(~repeated)
+            for i, row in zip(distinct, values[distinct].tolist()):
+                result[i] = tuple(row)
+            count_profile_event('retries', int(repeated.sum()))
+            pending = numpy.flatnonzero(repeated)
+            if len(pending) == 0:
+                return result
+
+        # Lines that repeat a value fall back to drawing one value at a
+        # time, as generate_sample() does.
+        for attempt in range(self.gen_count * MAX_SAMPLE_ATTEMPTS):
+            if len(pending) == 0:
+                break
+
+            candidates = self.gen_provider.generate_batch(
+                len(pending), select_rows(columns, pending))
+            still_pending = []
+            for i, candidate in zip(pending, candidates):
+                if candidate not in seen[i]:
+                    seen[i].add(candidate)
+                    samples[i].append(candidate)
+                else:
+                    count_profile_event('retries')
+                if len(samples[i]) < self.gen_count:
+                    still_pending.append(i)
+                else:
+                    result[i] = tuple(samples[i])
+            pending = numpy.array(still_pending, dtype=int)
+
+        if len(pending) > 0:
+            raise GenerationException(
+                "Could not generate {} different values for {} in {} tries.".format(
+                    self.gen_count, self.name,
+                    self.gen_count * MAX_SAMPLE_ATTEMPTS))
 
-        return tuple(samples)
+        return result
 
 
 class InterfaceGenerator(Generator):
@@ -134,12 +631,93 @@ class InterfaceGenerator(Generator):
     def generate_sample(self):
         return self.generator.generate_sample()
 
+    def generate_batch(self, n, columns):
+        return self.generator.generate_batch(n, columns)
+
+    def dependencies(self):
+        return self.generator.dependencies()
+
+    def to_data(self):
+        return ('interface', self.name, self.generator.to_data())
+
+
+class ProfiledGenerator(Generator):
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.calls = 0
+        self.samples = 0
+        self.seconds = 0.0
+        self.counters = dict((counter, 0) for counter in PROFILE_COUNTERS)
+
+        super(ProfiledGenerator, self).__init__(
+            generator.name, generator.content_map)
+
+    def generate_sample(self):
+        return self.profile(self.generator.generate_sample, 1)
+
+    def generate_batch(self, n, columns):
+        return self.profile(
+            lambda: self.generator.generate_batch(n, columns), n)
+
+    def profile(self, generate, samples):
+        global profile_counters
+
+        # Nested generators run inside this call, so everything they count
+        # belongs to this field.
+        profile_counters = self.counters
+        start = timeit.default_timer()
+        try:
+            return generate()
+        finally:
+            self.seconds += timeit.default_timer() - start
+            self.calls += 1
+            self.samples += samples
+            profile_counters = None
+
+    def dependencies(self):
+        return self.generator.dependencies()
+
+    def record(self):
+        record = {'field': self.name, 'calls': self.calls,
+                  'samples': self.samples, 'seconds': self.seconds}
+        record.update(self.counters)
+        return record
+
 
 class TemplateParser():
 
     def __init__(self):
         pass
 
+    def order_generators(self, generators):
+        by_name = dict((generator.name, generator)
+                       for generator in generators)
+        ordered = []
+        visit_state = {}
+
+        def visit(generator, path):
+            state = visit_state.get(generator.name)
+            if state == "done":
+                return
+            elif state == "visiting":
+                cycle = path[path.index(generator.name):] + [generator.name]
+                raise GenerationException(
+                    "Circular dependency between template lines: {}".format(
+                        " -> ".join(cycle)))
+
+            visit_state[generator.name] = "visiting"
+            for dependancy_name in sorted(generator.dependencies()):
+                if dependancy_name in by_name:
+                    visit(by_name[dependancy_name], path + [generator.name])
+            visit_state[generator.name] = "done"
+            ordered.append(generator)
+
+        for generator in generators:
+            visit(generator, [])
+
+        return ordered
+
     def parse_line(self, content_map, line):
         if len(line) > 4:
             var_name = line.split(':')[0]
@@ -266,32 +844,213 @@ class TemplateParser():
             return ValueGenerator(var_name, content_map, literal)
 
 
+def generator_from_data(data, content_map):
+    kind, name = data[0], data[1]
+    if kind == 'value':
+        return ValueGenerator(name, content_map, data[2])
+    elif kind == 'file':
+        return UniformFileGenerator(name, content_map, data[2])
+    elif kind == 'probability':
+        return ProbabilityGenerator(name, content_map, [
+            (generator_from_data(c, content_map), w) for c, w in data[2]])
+    elif kind == 'uniform':
+        return UniformProbabilityGenerator(name, content_map, [
+            generator_from_data(c, content_map) for c in data[2]])
+    elif kind == 'dependance':
+        return DependanceGenerator(name, content_map, [
+            (generator_from_data(c, content_map), condition)
+            for c, condition in data[2]], data[3])
+    elif kind == 'multiple':
+        return MultipleWithoutReplacementGenerator(
+            name, content_map, data[2],
+            generator_from_data(data[3], content_map))
+    elif kind == 'interface':
+        return InterfaceGenerator(
+            name, content_map, generator_from_data(data[2], content_map))
+
+    raise GenerationException(
+        "Unknown generator type {} in a compiled template.".format(kind))
+
+
 class AggregateGenerator(Generator):
 
-    def __init__(self, name, content_map, template_file):
+    def __init__(self, name, content_map, template_file, generators=None):
         template_parser = TemplateParser()
-        self.generators = []
-        self.name_sequence = []
-        for line in template_file:
-            self.generators.append(
-                template_parser.parse_line(
-                    content_map,
-                    line))
-            self.name_sequence.append(self.generators[-1].name)
+        if generators is None:
+            generators = [template_parser.parse_line(content_map, line)
+                          for line in template_file]
+        self.generators = generators
+        self.name_sequence = [generator.name for generator in generators]
+
+        self.evaluation_order = template_parser.order_generators(
+            self.generators)
 
         super(AggregateGenerator, self).__init__(name, content_map)
 
     def generate_sample(self):
-        for generator in self.generators:
-            content_map[generator.name] = generator.generate_sample()
-
-        for generator in self.generators:
-            if content_map[generator.name] is None:
-                sample = generator.generate_sample()
-                content_map[generator.name] = sample
+        self.content_map.clear()
+        for generator in self.evaluation_order:
+            self.content_map[generator.name] = generator.generate_sample()
 
         return self.name_sequence, self.content_map
 
+    def generate_batch(self, n):
+        columns = {}
+        for generator in self.evaluation_order:
+            columns[generator.name] = generator.generate_batch(n, columns)
+
+        return self.name_sequence, columns
+
+    def enable_profiling(self):
+        self.evaluation_order = [ProfiledGenerator(generator)
+                                 for generator in self.evaluation_order]
+
+    def profile_records(self):
+        return [generator.record() for generator in self.evaluation_order
+                if isinstance(generator, ProfiledGenerator)]
+
+    def to_data(self):
+        return tuple(generator.to_data() for generator in self.generators)
+
+
+def load_compiled_template(cache_name, template_hash):
+    header = COMPILED_TEMPLATE_MAGIC + b' ' + template_hash + b'\n'
+    try:
+        with open(cache_name, 'rb') as cache_file:
+            if cache_file.readline() != header:
+                return None
+            data = cache_file.read()
+    except (IOError, OSError):
+        return None
+
+    # The cache holds only literals, so a planted file can at worst fail
+    # to parse; it never runs code or names a class to load.
+    if not isinstance(data, str):
+        data = data.decode('utf-8')
+    try:
+        generators_data = ast.literal_eval(data)
+        content_map = {}
+        return AggregateGenerator(
+            "Generator", content_map, None,
+            [generator_from_data(generator_data, content_map)
+             for generator_data in generators_data])
+    except Exception:
+        return None
+
+
+def compile_template(template_file_name, template_lines):
+    with open(os.path.abspath(__file__), 'rb') as source_file:
+        source = source_file.read()
+    template = "".join(template_lines)
+    if not isinstance(template, bytes):
+        template = template.encode('utf-8')
+    # Python 2 and 3 read string literals differently, so each keeps its
+    # own cache.
+    version = str(sys.version_info[0]).encode('ascii')
+    template_hash = hashlib.sha1(
+        version + source + template).hexdigest().encode('ascii')
+
+    cache_name = template_file_name + ".compiled"
+    aggregate_generator = load_compiled_template(cache_name, template_hash)
+    if aggregate_generator is not None:
+        return aggregate_generator
+
+    aggregate_generator = AggregateGenerator(
+        "Generator",
+        {},
+        template_lines[1:])
+
+    data = repr(aggregate_generator.to_data())
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    temp_name = "{}.{}.tmp".format(cache_name, os.getpid())
+    try:
+        with open(temp_name, 'wb') as cache_file:
+            cache_file.write(
+                COMPILED_TEMPLATE_MAGIC + b' ' + template_hash + b'\n')
+            cache_file.write(data)
+        os.rename(temp_name, cache_name)
+    except (IOError, OSError):
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+
+    return aggregate_generator
+
+
+def generate_samples(aggregate_generator, count, batch):
+    if batch:
+        name_sequence, columns = aggregate_generator.generate_batch(count)
+        return (dict((name, columns[name][i]) for name in columns)
+                for i in range(count))
+    else:
+        return (aggregate_generator.generate_sample()[1]
+                for i in range(count))
+
+
+def generate_chunk(task):
+    template_file_name, template_lines, count, batch, source, profile = task
+    du.set_random_source(source)
+    aggregate_generator = compile_template(template_file_name, template_lines)
+    if profile:
+        aggregate_generator.enable_profiling()
+
+    samples = [dict(content_map) for content_map in generate_samples(
+        aggregate_generator, count, batch)]
+    return samples, aggregate_generator.profile_records()
+
+
+def chunk_samples(chunks, profile_records):
+    for samples, records in chunks:
+        profile_records.extend(records)
+        for content_map in samples:
+            yield content_map
+
+
+def merge_profile_records(profile_records):
+    merged = OrderedDict()
+    for record in profile_records:
+        if record['field'] not in merged:
+            merged[record['field']] = dict(record)
+        else:
+            for key, value in record.items():
+                if key != 'field':
+                    merged[record['field']][key] += value
+
+    return sorted(merged.values(), key=lambda record: -record['seconds'])
+
+
+def pad_field(name, width):
+    # Python 2 field names are UTF-8 encoded str, pad them by character.
+    if isinstance(name, bytes):
+        return name.decode('utf-8').ljust(width).encode('utf-8')
+    return name.ljust(width)
+
+
+def print_profile(profile_records, profile_format, output):
+    records = merge_profile_records(profile_records)
+    if profile_format == 'json':
+        json.dump(records, output, indent=2, sort_keys=True)
+        output.write("\n")
+        return
+
+    total_seconds = sum(record['seconds'] for record in records)
+    output.write("{} | {:>8} | {:>10} | {:>6} | {:>10} | {:>10} | {:>5} | "
+                 "{:>7}\n".format(pad_field("Field", 20), "Calls", "Total ms",
+                                   "%", "us/sample", "Lookups", "Loads",
+                                   "Retries"))
+    output.write("-" * 104 + "\n")
+    for record in records:
+        output.write("{} | {:>8} | {:>10.2f} | {:>5.1f}% | {:>10.2f} | "
+                     "{:>10} | {:>5} | {:>7}\n".format(
+                         pad_field(record['field'], 20),
+                         record['calls'],
+                         1000.0 * record['seconds'],
+                         100.0 * record['seconds'] / max(total_seconds, 1e-12),
+                         1e6 * record['seconds'] / max(record['samples'], 1),
+                         record['lookups'],
+                         record['file_loads'],
+                         record['retries']))
+
 
 def print_sample_aggregate(names, content_map):
     for i in range(len(names)):
@@ -349,41 +1108,122 @@ def save_sample_aggregate(log_file, names, content_map):
             output_line = output_line + content_map[names[i]][-1]
         log_file.write(output_line + "\n")
 
-parser = argparse.ArgumentParser(
-    description='Generate object decsriptions by template.')
-parser.add_argument('template_file')
-parser.add_argument('-c', help='number of objects to generate', type=int)
 
-args = parser.parse_args()
-
-repeats = 1
-if args.c is not None:
-    if args.c >= 1:
-        repeats = args.c
-
-for i in range(repeats):
-    template_file_name = args.template_file + ".txt"
-    template_file = open(template_file_name, 'r')
-    file_type = template_file.readline().strip()
-
-    content_map = {}
+def main():
+    global line_index_threshold
+
+    parser = argparse.ArgumentParser(
+        description='Generate object decsriptions by template.')
+    parser.add_argument('template_file')
+    parser.add_argument('-c', help='number of objects to generate', type=int)
+    parser.add_argument(
+        '--index_threshold',
+        help='word lists of at least this many bytes are sampled through a memory-mapped line index (.idx file next to the list), 0 indexes every list, a negative value disables indexing',
+        type=int,
+        default=line_index_threshold)
+    parser.add_argument(
+        '-b',
+        '--batch',
+        help='generate all objects at once with the columnar batch generator (requires numpy)',
+        action='store_true')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='number of worker processes to split the objects between',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help='seed for the random generators, the same seed and number of jobs always generate the same objects',
+        type=int)
+    parser.add_argument(
+        '--rng',
+        help='NumPy bit generator for --batch',
+        choices=sorted(du.BIT_GENERATORS),
+        default='pcg64')
+    parser.add_argument(
+        '--profile',
+        help='time every template field and count its word list reads and retries, then print a ranked report (or JSON) to stderr',
+        nargs='?',
+        const='text',
+        choices=['text', 'json'])
+
+    args = parser.parse_args()
+
+    line_index_threshold = args.index_threshold
+
+    repeats = 1
+    if args.c is not None:
+        if args.c >= 1:
+            repeats = args.c
+
+    try:
+        template_file_name = args.template_file + ".txt"
+        with open(template_file_name, 'r') as template_file:
+            template_lines = template_file.readlines()
+        file_type = template_lines[0].strip() if template_lines else ""
+
+        jobs = max(1, args.jobs)
+        source = du.seed_random_source(args.seed, args.rng)
+
+        if file_type == "TEMPLATE":
+            aggregate_generator = compile_template(
+                template_file_name, template_lines)
+            name_sequence = aggregate_generator.name_sequence
+            profile_records = []
+
+            pool = None
+            if jobs > 1:
+                # Chunk i always gets spawned stream i, so the output only
+                # depends on the seed and the number of jobs, not on worker
+                # scheduling.
+                tasks = []
+                for i, chunk_source in enumerate(source.spawn(jobs)):
+                    count = repeats // jobs + (1 if i < repeats % jobs else 0)
+                    if count > 0:
+                        tasks.append((template_file_name, template_lines, count,
+                                      args.batch, chunk_source,
+                                      args.profile is not None))
+
+                pool = multiprocessing.Pool(len(tasks))
+                samples = chunk_samples(
+                    pool.imap(generate_chunk, tasks), profile_records)
+            else:
+                if args.profile is not None:
+                    aggregate_generator.enable_profiling()
+                samples = generate_samples(
+                    aggregate_generator, repeats, args.batch)
 
-    if file_type == "TEMPLATE":
-        aggregate_generator = AggregateGenerator(
-            "Generator",
-            content_map,
-            template_file)
+            try:
+                with open(template_file_name + ".txt.log", 'a', 1 << 16) \
+                        as log_file:
+                    for i, content_map in enumerate(samples):
+                        print_sample_aggregate(name_sequence, content_map)
+                        save_sample_aggregate(
+                            log_file, name_sequence, content_map)
+
+                        log_file.write("\n")
+
+                        if i != repeats - 1:
+                            print("")
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+            if args.profile is not None:
+                if pool is None:
+                    profile_records = aggregate_generator.profile_records()
+                print_profile(profile_records, args.profile, sys.stderr)
+        else:
+            ufg = UniformFileGenerator("UFG", {}, template_file_name)
+            for i in range(repeats):
+                print(ufg.generate_sample())
 
-        log_file = open(template_file_name + ".txt.log", 'a')
-        name_sequence, content_map = aggregate_generator.generate_sample()
-        print_sample_aggregate(name_sequence, content_map)
-        save_sample_aggregate(log_file, name_sequence, content_map)
+    except GenerationException as ex:
+        print(ex.args[0])
 
-        log_file.write("\n")
 
-        if i != repeats - 1:
-            print("")
-    else:
-        template_file.close()
-        ufg = UniformFileGenerator("UFG", content_map, template_file_name)
-        print(ufg.generate_sample())
+if __name__ == '__main__':
+    main()
@@ -1,199 +1,707 @@
 #!/usr/bin/env python
 
 import argparse
-import dice_util as du
+import shutil
+import sys
+import tempfile
+if __package__:
+    from . import dice_util as du
+else:
+    import dice_util as du
+
+
+BINARY_DTYPE = '<i4'
+SCALAR_ROLL_LIMIT = 32
+PRECISION_Z = 1.959964
+PRECISION_FIRST_ROLLS = 1000
+PRECISION_ROLL_LIMIT = 10 ** 8
+D20_FACES = 20
 
 
 class DiceArgumentException(Exception):
     pass
 
-parser = argparse.ArgumentParser(
-    description='Simple dice roller for D&D 5th edition.')
-parser.add_argument(
-    'die_code',
-    help='Code for the dice roll, ex.: 3d6+4-1d4-1',
-    nargs='+')
-
-
-formatting_group = parser.add_mutually_exclusive_group()
-formatting_group.add_argument(
-    '-l',
-    '--line_print',
-    help='print repeated rolls in a line instead of a column',
-    action='store_true')
-formatting_group.add_argument(
-    '-v',
-    '--verbose',
-    help='print extra info when rolling multiple dice',
-    action='store_true')
-
-parser.add_argument(
-    '-c',
-    '--count',
-    help='number of times to repeat the roll',
-    type=int)
-parser.add_argument(
-    '-t',
-    '--transpose',
-    help='print all rolls of each die in a line instead of a column',
-    action='store_true')
-
-
-group = parser.add_mutually_exclusive_group()
-group.add_argument(
-    '-a',
-    '--advantage',
-    help='roll width advantage (die_code has to be of the form 1d20{+-x})',
-    action='store_true')
-group.add_argument(
-    '-d',
-    '--disadvantage',
-    help='roll width disadvantage (die_code has to be of the form 1d20{+-x})',
-    action='store_true')
-
-group.add_argument(
-    '-crit',
-    '--critical',
-    help='roll critical hit damage',
-    action='store_true')
-
-group.add_argument(
-    '-b',
-    '--best',
-    help='only sum specified number of best rolls (can only include one die type in a roll)',
-    type=int)
-group.add_argument(
-    '-w',
-    '--worst',
-    help='only sum specified number of worst rolls (can only include one die type in a roll)',
-    type=int)
-
-args = parser.parse_args()
-
-repeats = 1
-if args.count is not None:
-    if args.count >= 1:
-        repeats = args.count
-
-try:
-    parsed_dice = []
-    for die_code in args.die_code:
-        die, bonus = du.parse_roll_line(die_code)
-        parsed_dice.append((die, bonus))
-
-    rolls = []
-    for i in range(repeats):
-        rolls.append([])
-        for dice, bonus in parsed_dice:
-            if len(dice) == 0:
-                rolls[i].append(bonus)
-            elif args.advantage:
-                if dice[0][1] > 1 or dice[0][2] != 20:
-                    raise DiceArgumentException(
-                        "Can only do a 1d20+x type of roll with advantage.")
-
-                rolls[i].append(
-                    max(du.roll_batch(dice[0]), du.roll_batch(dice[0])) + bonus)
-            elif args.disadvantage:
-                if dice[0][1] > 1 or dice[0][2] != 20:
-                    raise DiceArgumentException(
-                        "Can only do a 1d20+x type of roll with disadvantage.")
-
-                rolls[i].append(
-                    max(du.roll_batch(dice[0]), du.roll_batch(dice[0])) + bonus)
-            elif args.best is not None:
-                if len(dice) > 1:
-                    raise DiceArgumentException(
-                        "You can use only one type of die.")
-                elif dice[0][1] < int(args.best):
-                    raise DiceArgumentException(
-                        "You can't pick out more dice than you roll.")
-
-                rolls[i].append(sum(sorted(du.roll_batch(dice[0], sumup=False), reverse=True)[
-                                :int(args.best)]) + bonus)
-            elif args.worst is not None:
-                if len(dice) > 1:
-                    raise DiceArgumentException(
-                        "You can use only one type of die.")
-                elif dice[0][1] < int(args.worst):
-                    raise DiceArgumentException(
-                        "You can't pick out more dice than you roll.")
-
-                rolls[i].append(
-                    sum(sorted(du.roll_batch(dice[0], sumup=False))[:int(args.worst)]) + bonus)
-            elif args.critical is True:
-                rolls[i].append(du.roll_all(dice) + du.roll_all(dice) + bonus)
+
+class RollEstimate(object):
+
+    def __init__(self, strata=1, paired=False):
+        import numpy
+
+        self.strata = strata
+        self.paired = paired
+        self.offset = 0
+        self.roll_count = 0
+        self.counts = numpy.zeros((strata, 0), dtype=numpy.int64)
+        self.both_counts = numpy.zeros(0, dtype=numpy.int64)
+        self.pair_sum_counts = numpy.zeros(0, dtype=numpy.int64)
+
+    def widen(self, values):
+        offset = self.offset
+        self.counts, self.offset = du.widen_counts(
+            self.counts, offset, int(values.min()), int(values.max()))
+        high = self.offset + self.counts.shape[1] - 1
+        self.both_counts, _ = du.widen_counts(
+            self.both_counts, offset, self.offset, high)
+        self.pair_sum_counts, _ = du.widen_counts(
+            self.pair_sum_counts, 2 * offset, 2 * self.offset, 2 * high)
+
+    def add(self, values, stratum=0):
+        import numpy
+
+        self.widen(values)
+        width = self.counts.shape[1]
+        self.counts += numpy.bincount(
+            stratum * width + values - self.offset,
+            minlength=self.strata * width).reshape(self.strata, width)
+        self.roll_count += len(values)
+
+    def add_pairs(self, first, second):
+        import numpy
+
+        self.add(numpy.concatenate([first, second]))
+        equal = first == second
+        self.both_counts += numpy.bincount(
+            first[equal] - self.offset, minlength=len(self.both_counts))
+        self.pair_sum_counts += numpy.bincount(
+            first + second - 2 * self.offset,
+            minlength=len(self.pair_sum_counts))
+
+    def unit_count(self):
+        if self.paired:
+            return self.roll_count // 2
+        return self.roll_count
+
+    def probabilities(self):
+        return self.counts.sum(axis=0) / float(self.roll_count)
+
+    def distribution(self):
+        return du.RollDistribution(self.offset, self.probabilities())
+
+    def mean_variance(self):
+        import numpy
+
+        if self.paired:
+            values = (2 * self.offset + numpy.arange(
+                len(self.pair_sum_counts))) / 2.0
+            weights = self.pair_sum_counts / float(self.unit_count())
+        else:
+            # Every stratum holds the same number of rolls, so the variance
+            # of the overall mean is the average within-stratum variance.
+            values = self.offset + numpy.arange(self.counts.shape[1])
+            weights = self.counts / float(self.roll_count // self.strata)
+
+        means = numpy.reshape(numpy.dot(weights, values), (-1, 1))
+        variances = (weights * (values - means) ** 2).sum(axis=-1)
+        return float(numpy.mean(variances)) / self.unit_count()
+
+    def probability_variances(self):
+        if self.paired:
+            probabilities = self.probabilities()
+            pairs = float(self.unit_count())
+            squares = (self.counts[0] + 2 * self.both_counts) / (4 * pairs)
+            return (squares - probabilities ** 2) / pairs
+
+        probabilities = self.counts / float(self.roll_count // self.strata)
+        return (probabilities * (1.0 - probabilities)).mean(axis=0) / \
+            self.roll_count
+
+    def mean_halfwidth(self):
+        return PRECISION_Z * max(0.0, self.mean_variance()) ** 0.5
+
+    def probability_halfwidths(self):
+        import numpy
+
+        # Wilson score widths, so values that have not come up yet still
+        # count as uncertain.
+        n = float(self.unit_count())
+        z = PRECISION_Z
+        variances = numpy.maximum(self.probability_variances(), 0.0)
+        return z / (1.0 + z * z / n) * \
+            (variances + z * z / (4.0 * n * n)) ** 0.5
+
+
+def check_dice(dice, args):
+    if len(dice) == 0:
+        return
+
+    if args.advantage or args.disadvantage:
+        if dice[0][1] > 1 or dice[0][2] != 20:
+            raise DiceArgumentException(
+                "Can only do a 1d20+x type of roll with {}.".format(
+                    "advantage" if args.advantage else "disadvantage"))
+    elif args.best is not None or args.worst is not None:
+        pick = args.best if args.best is not None else args.worst
+        if args.exact and len(dice) > 1:
+            raise DiceArgumentException(
+                "You can use only one type of die with --exact.")
+        elif sum(die_count for op_type, die_count, die_type in dice) < pick:
+            raise DiceArgumentException(
+                "You can't pick out more dice than you roll.")
+
+
+def roll_row(parsed_dice, args):
+    row = []
+    for roll in parsed_dice:
+        if len(roll.dice) == 0:
+            row.append(roll.bonus)
+        elif args.advantage or args.disadvantage:
+            op_type, die_count, die_type = roll.dice[0]
+            d20_rolls = du.roll_batch((op_type, 2, die_type), sumup=False)
+            if args.advantage:
+                row.append(max(d20_rolls) + roll.bonus)
             else:
-                rolls[i].append(du.roll_all(dice) + bonus)
+                row.append(min(d20_rolls) + roll.bonus)
+        elif args.best is not None:
+            row.append(roll.roll_keep(args.best, highest=True))
+        elif args.worst is not None:
+            row.append(roll.roll_keep(args.worst, highest=False))
+        elif args.critical is True:
+            row.append(roll.critical().roll())
+        else:
+            row.append(roll.roll())
+
+    return row
+
+
+def roll_modifiers(args):
+    return {'advantage': args.advantage,
+            'disadvantage': args.disadvantage,
+            'critical': args.critical,
+            'best': args.best,
+            'worst': args.worst}
+
+
+def samples_from_pmf(roll, args):
+    if args.sampler == 'dice':
+        return False
+    elif len(roll.dice) > 1 and \
+            (args.best is not None or args.worst is not None):
+        # Mixed pools have no exact distribution to sample from.
+        return False
+    elif args.sampler == 'pmf':
+        return True
+    elif args.best is not None or args.worst is not None:
+        # Exact kept-dice distributions cost far more to build than big
+        # pools cost to roll.
+        return False
+
+    die_count = roll.die_count()
+    if args.critical:
+        die_count *= 2
+    return die_count >= du.PMF_SAMPLING_DICE
+
+
+def roll_chunk(parsed_dice, repeats, args):
+    import numpy
+
+    # Each die code draws from its own stream, so seeded results are the
+    # same whatever the chunk size.
+    source = du.random_source()
+    try:
+        columns = [roll_column(roll, repeats, args, source.derive('column', i))
+                   for i, roll in enumerate(parsed_dice)]
+    finally:
+        du.set_random_source(source)
+
+    return numpy.column_stack(columns)
+
+
+def roll_column(roll, repeats, args, source):
+    import numpy
+
+    du.set_random_source(source)
+    if len(roll.dice) == 0:
+        return numpy.full(repeats, roll.bonus, dtype=numpy.int64)
+    elif samples_from_pmf(roll, args):
+        return roll.sample_batch(repeats, **roll_modifiers(args))
+    elif args.advantage or args.disadvantage:
+        op_type, die_count, die_type = roll.dice[0]
+        d20_roll = du.RollExpression([(op_type, 2, die_type)], 0)
+        _, (d20_rolls,) = d20_roll.roll_batch(repeats, per_die=True)
+        if args.advantage:
+            return d20_rolls.max(axis=1) + roll.bonus
+        else:
+            return d20_rolls.min(axis=1) + roll.bonus
+    elif args.best is not None:
+        return roll.roll_keep_batch(repeats, args.best, True)
+    elif args.worst is not None:
+        return roll.roll_keep_batch(repeats, args.worst, False)
+    elif args.critical is True:
+        return roll.critical().roll_batch(repeats)
+    else:
+        return roll.roll_batch(repeats)
 
-    if args.transpose:
-        rolls = map(list, zip(*rolls))
 
+def roll_rows(parsed_dice, repeats, args):
+    # A few rows are quicker to roll one by one than to start NumPy for.
+    # Seeded rolls always come from the NumPy streams, so the same seed
+    # gives the same rolls whatever the count and chunk size.
+    if repeats <= SCALAR_ROLL_LIMIT and args.seed is None:
+        return [roll_row(parsed_dice, args) for i in range(repeats)]
+
+    return roll_chunk(parsed_dice, repeats, args).tolist()
+
+
+def format_cells(results, max_die_line_len, args):
     if args.verbose:
-        dice_strings = []
-        for dice, bonus in parsed_dice:
-            output_string = ""
-            if len(dice) > 0:
-                output_string = output_string + \
-                    str(dice[0][1]) + 'd' + str(dice[0][2])
-                if len(dice) > 1:
-                    for die in dice[1:]:
-                        output_string = output_string + \
-                            die[0] + str(die[1]) + 'd' + str(die[2])
-
-                if bonus > 0:
-                    output_string = output_string + "+" + str(bonus)
-                elif bonus < 0:
-                    output_string = output_string + "-" + str(bonus)
+        return "".join(("| " + str(result)).ljust(max_die_line_len)
+                       for result in results)
+    else:
+        return " ".join(str(result) for result in results)
+
+
+def write_binary(parsed_dice, repeats, chunk_size, args):
+    import numpy
+
+    sys.stdout.flush()
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    if args.format == 'npy':
+        numpy.lib.format.write_array_header_1_0(output, {
+            'descr': BINARY_DTYPE,
+            'fortran_order': False,
+            'shape': (repeats, len(parsed_dice))})
+
+    for start in range(0, repeats, chunk_size):
+        rolls = roll_chunk(
+            parsed_dice, min(start + chunk_size, repeats) - start, args)
+        output.write(rolls.astype(BINARY_DTYPE).tobytes())
+
+    output.flush()
+
+
+def print_distributions(die_codes, parsed_dice, args):
+    for i, roll in enumerate(parsed_dice):
+        distribution = roll.pmf(**roll_modifiers(args))
+
+        print("{}: avg = {:.4f}, std = {:.4f}".format(
+            die_codes[i], distribution.mean(), distribution.std()))
+        print("Percentiles (5/25/50/75/95): {}".format(
+            " / ".join(str(distribution.percentile(q))
+                       for q in (5, 25, 50, 75, 95))))
+        print("  Result | P(= result) | P(>= result)")
+        for value in distribution.values():
+            print("{:>8} | {:>10.4f}% | {:>11.4f}%".format(
+                value,
+                100.0 * distribution.probability(value),
+                100.0 * distribution.prob_at_least(value)))
+
+        if i < len(parsed_dice) - 1:
+            print("")
+
+
+def split_d20(roll):
+    for i, (op_type, die_count, die_type) in enumerate(roll.dice):
+        if die_type == D20_FACES:
+            rest = list(roll.dice)
+            if die_count > 1:
+                rest[i] = (op_type, die_count - 1, die_type)
             else:
-                output_string = output_string + str(bonus)
+                del rest[i]
+            sign = -1 if op_type == '-' else 1
+            return sign, du.RollExpression(rest, roll.bonus)
+
+    return None
+
+
+def d20_faces(repeats, variance_reduction):
+    import numpy
+
+    # Faces repeat every 20 rows, or every 2 rows for antithetic pairs, so
+    # the layout is the same however the rolls are split into chunks.
+    if variance_reduction == 'stratified':
+        return numpy.tile(numpy.arange(1, D20_FACES + 1),
+                          repeats // D20_FACES)
+
+    # Antithetic pairs: every second face mirrors the one before it.
+    faces = numpy.empty(repeats, dtype=numpy.int64)
+    faces[0::2] = du.random_source().derive('d20').integers(
+        1, D20_FACES + 1, size=repeats // 2)
+    faces[1::2] = D20_FACES + 1 - faces[0::2]
+    return faces
+
+
+def roll_given_d20(roll, faces, args):
+    import numpy
+
+    if args.critical:
+        roll = roll.critical()
+    sign, rest = split_d20(roll)
+    faces = sign * faces
+
+    if args.advantage or args.disadvantage:
+        other = sign * du.random_source().derive('advantage').integers(
+            1, D20_FACES + 1, size=len(faces))
+        if args.advantage:
+            return numpy.maximum(faces, other) + rest.bonus
+        else:
+            return numpy.minimum(faces, other) + rest.bonus
+    elif args.best is not None or args.worst is not None:
+        pool = [faces.reshape(-1, 1)]
+        if len(rest.dice) > 0:
+            pool.append(du.roll_line_pool(rest.dice, len(faces), rest.groups()))
+        if args.best is not None:
+            kept = du.keep_dice(numpy.concatenate(pool, axis=1), args.best, True)
+        else:
+            kept = du.keep_dice(
+                numpy.concatenate(pool, axis=1), args.worst, False)
+        return kept + rest.bonus
+    else:
+        return faces + rest.roll_totals(len(faces), args.sampler)
 
-            dice_strings.append(output_string)
 
-        number_strings = [str(num) for num in range(repeats)]
+def precision_ratio(estimate, args):
+    ratios = []
+    if args.precision is not None:
+        ratios.append(estimate.mean_halfwidth() / args.precision)
+    if args.probability_precision is not None:
+        ratios.append(100.0 * estimate.probability_halfwidths().max() /
+                      args.probability_precision)
 
-        if args.transpose:
-            number_strings, dice_strings = dice_strings, number_strings
-
-        max_die_line_len = 10
-        for die_string in dice_strings:
-            max_die_line_len = max(max_die_line_len, len(die_string) + 2)
-
-        front_pad_length = 2
-        for number_string in number_strings:
-            front_pad_length = max(front_pad_length, len(number_string) + 1)
-
-        output_line = " " * front_pad_length
-        for die_string in dice_strings:
-            output_string = "| " + die_string
-            output_string = output_string + " " * \
-                (max_die_line_len - len(output_string))
-            output_line = output_line + output_string
-
-        output_line = output_line + "|"
-        print(output_line)
-        output_line = "-" * len(output_line)
-        print(output_line)
-
-        output_line = ""
-        for i, roll in enumerate(rolls):
-            output_line = str(number_strings[i])
-            output_line = output_line + " " * \
-                (front_pad_length - len(str(number_strings[i])))
-
-            for result in roll:
-                output_string = "| " + str(result)
-                output_string = output_string + " " * \
-                    (max_die_line_len - len(output_string))
-                output_line = output_line + output_string
-
-            print(output_line + "|")
+    return max(ratios)
+
+
+def estimate_roll(roll, args, source):
+    du.set_random_source(source)
+    variance_reduction = args.variance_reduction
+    if split_d20(roll) is None:
+        variance_reduction = 'none'
+
+    if variance_reduction == 'stratified':
+        estimate = RollEstimate(strata=D20_FACES)
+    elif variance_reduction == 'antithetic':
+        estimate = RollEstimate(paired=True)
     else:
-        for roll in rolls:
-            for result in roll:
-                print(result,)
-            if not args.line_print:
-                print("")
-
-except DiceArgumentException as ex:
-    print(ex.args[0])
+        estimate = RollEstimate()
+
+    limit = PRECISION_ROLL_LIMIT
+    if args.count is not None:
+        limit = max(1, args.count)
+
+    # Whole multiples of 20 rolls keep the d20 strata and pairs balanced,
+    # so the cap rounds down to one.
+    step = 1
+    if variance_reduction != 'none':
+        step = D20_FACES
+        limit -= limit % D20_FACES
+        if limit == 0:
+            raise DiceArgumentException(
+                "--variance_reduction needs -c of at least {}.".format(
+                    D20_FACES))
+    chunk_size = max(step, args.chunk_size - args.chunk_size % step)
+
+    rolls = PRECISION_FIRST_ROLLS
+    while True:
+        rolls = min(-(-rolls // step) * step, limit - estimate.roll_count)
+        for start in range(0, rolls, chunk_size):
+            repeats = min(chunk_size, rolls - start)
+            if variance_reduction == 'none':
+                estimate.add(roll_chunk([roll], repeats, args)[:, 0])
+                continue
+
+            faces = d20_faces(repeats, variance_reduction)
+            totals = roll_given_d20(roll, faces, args)
+            if variance_reduction == 'stratified':
+                estimate.add(totals, faces - 1)
+            else:
+                estimate.add_pairs(totals[0::2], totals[1::2])
+
+        ratio = precision_ratio(estimate, args)
+        if ratio <= 1.0:
+            return estimate, variance_reduction, True
+        elif estimate.roll_count >= limit:
+            return estimate, variance_reduction, False
+
+        # The interval shrinks with the square root of the roll count, so
+        # aim straight for the count the current estimate asks for, but
+        # never more than double the rolls so far in one step.
+        needed = int(estimate.roll_count * ratio * ratio) + 1
+        rolls = min(max(needed - estimate.roll_count, PRECISION_FIRST_ROLLS),
+                    estimate.roll_count)
+
+
+def print_estimates(die_codes, parsed_dice, args):
+    source = du.random_source()
+    for i, roll in enumerate(parsed_dice):
+        try:
+            estimate, variance_reduction, converged = estimate_roll(
+                roll, args, source.derive('estimate', i))
+        finally:
+            du.set_random_source(source)
+        distribution = estimate.distribution()
+        halfwidths = estimate.probability_halfwidths()
+
+        print("{}: avg = {:.4f} +/- {:.4f}, std = {:.4f}".format(
+            die_codes[i], distribution.mean(), estimate.mean_halfwidth(),
+            distribution.std()))
+        if variance_reduction == 'none':
+            print("Rolls: {}".format(estimate.roll_count))
+        else:
+            print("Rolls: {} ({} d20)".format(
+                estimate.roll_count, variance_reduction))
+        if not converged:
+            print("Stopped at the roll limit before reaching the requested "
+                  "precision.")
+        print("Percentiles (5/25/50/75/95): {}".format(
+            " / ".join(str(distribution.percentile(q))
+                       for q in (5, 25, 50, 75, 95))))
+        print("  Result | P(= result) (95% interval) | P(>= result)")
+        for value in distribution.values():
+            print("{:>8} | {:>10.4f}% +/- {:>7.4f}% | {:>11.4f}%".format(
+                value,
+                100.0 * distribution.probability(value),
+                100.0 * halfwidths[value - estimate.offset],
+                100.0 * distribution.prob_at_least(value)))
+
+        if i < len(parsed_dice) - 1:
+            print("")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simple dice roller for D&D 5th edition.')
+    parser.add_argument(
+        'die_code',
+        help='Code for the dice roll, ex.: 3d6+4-1d4-1',
+        nargs='+')
+
+
+    formatting_group = parser.add_mutually_exclusive_group()
+    formatting_group.add_argument(
+        '-l',
+        '--line_print',
+        help='print repeated rolls in a line instead of a column',
+        action='store_true')
+    formatting_group.add_argument(
+        '-v',
+        '--verbose',
+        help='print extra info when rolling multiple dice',
+        action='store_true')
+
+    parser.add_argument(
+        '-c',
+        '--count',
+        help='number of times to repeat the roll',
+        type=int)
+    parser.add_argument(
+        '-t',
+        '--transpose',
+        help='print all rolls of each die in a line instead of a column',
+        action='store_true')
+    parser.add_argument(
+        '--chunk_size',
+        help='number of repeats rolled and written at a time',
+        type=int,
+        default=65536)
+    parser.add_argument(
+        '-f',
+        '--format',
+        help='output format: text, npy (NumPy array file) or raw (little-endian int32, one row of die codes per repeat)',
+        choices=['text', 'npy', 'raw'],
+        default='text')
+    parser.add_argument(
+        '-e',
+        '--exact',
+        help='print the exact probability distribution of the roll instead of rolling',
+        action='store_true')
+    parser.add_argument(
+        '-p',
+        '--precision',
+        help='roll in growing batches until the 95%% confidence interval of the average is within this many points either side, then print the estimated distribution and the number of rolls used (-c caps the rolls, {} by default)'.format(PRECISION_ROLL_LIMIT),
+        type=float)
+    parser.add_argument(
+        '--probability_precision',
+        help='like --precision, but for the probability of every result, in percentage points',
+        type=float)
+    parser.add_argument(
+        '--variance_reduction',
+        help='with --precision or --probability_precision, roll the d20 of each roll that has one in antithetic pairs (every face together with its mirror) or stratified (every face equally often), which needs fewer rolls for the same interval',
+        choices=['none', 'antithetic', 'stratified'],
+        default='none')
+    parser.add_argument(
+        '--sampler',
+        help='how batches of rolls are made: dice rolls every die, pmf draws each total from the exact distribution of the roll (one random number per roll), auto uses pmf for sums and critical hits of at least {} dice'.format(du.PMF_SAMPLING_DICE),
+        choices=['auto', 'dice', 'pmf'],
+        default='auto')
+    parser.add_argument(
+        '--seed',
+        help='seed for all rolls, the same seed always gives the same results',
+        type=int)
+    parser.add_argument(
+        '--rng',
+        help='NumPy bit generator for batch rolls',
+        choices=sorted(du.BIT_GENERATORS),
+        default='pcg64')
+
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '-a',
+        '--advantage',
+        help='roll width advantage (die_code has to be of the form 1d20{+-x})',
+        action='store_true')
+    group.add_argument(
+        '-d',
+        '--disadvantage',
+        help='roll width disadvantage (die_code has to be of the form 1d20{+-x})',
+        action='store_true')
+
+    group.add_argument(
+        '-crit',
+        '--critical',
+        help='roll critical hit damage',
+        action='store_true')
+
+    group.add_argument(
+        '-b',
+        '--best',
+        help='only sum specified number of best rolls out of all dice in a roll (--exact needs a single die type)',
+        type=int)
+    group.add_argument(
+        '-w',
+        '--worst',
+        help='only sum specified number of worst rolls out of all dice in a roll (--exact needs a single die type)',
+        type=int)
+
+    args = parser.parse_args()
+
+    repeats = 1
+    if args.count is not None:
+        if args.count >= 1:
+            repeats = args.count
+
+    du.seed_random_source(args.seed, args.rng)
+
+    try:
+        parsed_dice = [du.parse_roll_line(die_code)
+                       for die_code in args.die_code]
+
+        for roll in parsed_dice:
+            check_dice(roll.dice, args)
+
+        if args.exact:
+            print_distributions(args.die_code, parsed_dice, args)
+            return
+
+        if args.precision is not None or \
+                args.probability_precision is not None:
+            if args.format != 'text' or args.transpose or args.verbose or \
+                    args.line_print:
+                raise DiceArgumentException(
+                    "--precision prints a summary and can't be used with "
+                    "-f, -t, -v or -l.")
+            elif min(precision for precision in
+                     (args.precision, args.probability_precision)
+                     if precision is not None) <= 0:
+                raise DiceArgumentException(
+                    "Precision has to be a positive number.")
+
+            print_estimates(args.die_code, parsed_dice, args)
+            return
+        elif args.variance_reduction != 'none':
+            raise DiceArgumentException(
+                "--variance_reduction only works with --precision or "
+                "--probability_precision.")
+
+        chunk_size = max(1, args.chunk_size)
+        chunk_starts = range(0, repeats, chunk_size)
+
+        if args.format != 'text':
+            if args.transpose or args.verbose or args.line_print:
+                raise DiceArgumentException(
+                    "-t, -v and -l can only be used with text output.")
+
+            write_binary(parsed_dice, repeats, chunk_size, args)
+            return
+
+        dice_strings = [str(roll) for roll in parsed_dice]
+        number_length = len(str(repeats - 1))
+        if args.transpose:
+            label_length = max(len(die_string) for die_string in dice_strings)
+            header_length = number_length
+        else:
+            label_length = number_length
+            header_length = max(len(die_string) for die_string in dice_strings)
+
+        max_die_line_len = max(10, header_length + 2)
+        front_pad_length = max(2, label_length + 1)
+
+        if args.transpose:
+            if args.verbose:
+                sys.stdout.write(" " * front_pad_length)
+                for start in chunk_starts:
+                    stop = min(start + chunk_size, repeats)
+                    sys.stdout.write(
+                        format_cells(range(start, stop), max_die_line_len, args))
+                sys.stdout.write("|\n")
+
+                sys.stdout.write("-" * front_pad_length)
+                for start in chunk_starts:
+                    stop = min(start + chunk_size, repeats)
+                    sys.stdout.write("-" * ((stop - start) * max_die_line_len))
+                sys.stdout.write("-\n")
+
+            # Each die code becomes one output line, so its rolls are spooled
+            # to disk instead of being held in memory until the end.
+            spools = [tempfile.TemporaryFile('w+') for roll in parsed_dice]
+            for start in chunk_starts:
+                rolls = roll_rows(
+                    parsed_dice, min(start + chunk_size, repeats) - start, args)
+                for spool, column in zip(spools, zip(*rolls)):
+                    if start > 0 and not args.verbose:
+                        spool.write(" ")
+                    spool.write(format_cells(column, max_die_line_len, args))
+
+            for i, spool in enumerate(spools):
+                if args.verbose:
+                    sys.stdout.write(dice_strings[i].ljust(front_pad_length))
+                elif args.line_print and i > 0:
+                    sys.stdout.write(" ")
+
+                spool.seek(0)
+                shutil.copyfileobj(spool, sys.stdout)
+                spool.close()
+
+                if args.verbose:
+                    sys.stdout.write("|\n")
+                elif not args.line_print:
+                    sys.stdout.write("\n")
+
+            if args.line_print:
+                sys.stdout.write("\n")
+        else:
+            if args.verbose:
+                output_line = " " * front_pad_length + \
+                    format_cells(dice_strings, max_die_line_len, args) + "|"
+                sys.stdout.write(output_line + "\n")
+                sys.stdout.write("-" * len(output_line) + "\n")
+
+            for start in chunk_starts:
+                rolls = roll_rows(
+                    parsed_dice, min(start + chunk_size, repeats) - start, args)
+
+                if args.verbose:
+                    output_lines = [
+                        str(start + i).ljust(front_pad_length) +
+                        format_cells(roll, max_die_line_len, args) + "|"
+                        for i, roll in enumerate(rolls)]
+                else:
+                    output_lines = [format_cells(roll, max_die_line_len, args)
+                                    for roll in rolls]
+
+                if args.line_print:
+                    if start > 0:
+                        sys.stdout.write(" ")
+                    sys.stdout.write(" ".join(output_lines))
+                else:
+                    sys.stdout.write("\n".join(output_lines) + "\n")
+
+            if args.line_print:
+                sys.stdout.write("\n")
+
+    except DiceArgumentException as ex:
+        print(ex.args[0])
+
+
+if __name__ == '__main__':
+    main()
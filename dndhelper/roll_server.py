@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import traceback
+if __package__:
+    from . import dice_util as du
+    from . import combat
+    from . import generate
+else:
+    import dice_util as du
+    import combat
+    import generate
+
+
+class ServerRequestException(Exception):
+    pass
+
+
+def parse_options(arguments, flags, valued):
+    positional = []
+    options = {}
+    arguments = list(arguments)
+    while len(arguments) > 0:
+        argument = arguments.pop(0)
+        if argument in flags:
+            options[argument] = True
+        elif argument in valued:
+            if len(arguments) == 0:
+                raise ServerRequestException(
+                    "Option {} needs a value.".format(argument))
+            try:
+                options[argument] = int(arguments.pop(0))
+            except ValueError:
+                raise ServerRequestException(
+                    "Option {} needs an integer value.".format(argument))
+        elif argument.startswith('-') and not argument[1:2].isdigit():
+            raise ServerRequestException(
+                "Unknown option {}.".format(argument))
+        else:
+            positional.append(argument)
+
+    return positional, options
+
+
+def parse_roll(roll_line, max_dice):
+    roll = du.parse_roll_line(roll_line)
+    if roll.die_count() > max_dice:
+        raise ServerRequestException(
+            "{} rolls more than {} dice.".format(roll_line, max_dice))
+    return roll
+
+
+def request_count(options, max_count):
+    count = options.get('-c', 1)
+    if count < 1 or count > max_count:
+        raise ServerRequestException(
+            "Count must be between 1 and {}.".format(max_count))
+    return count
+
+
+class RollServer(object):
+
+    def __init__(self, max_count, max_dice):
+        self.max_count = max_count
+        self.max_dice = max_dice
+        self.templates = {}
+        self.commands = {
+            'roll': self.roll,
+            'attack': self.attack,
+            'generate': self.generate,
+        }
+
+    def handle_line(self, line):
+        arguments = line.split()
+        if len(arguments) == 0:
+            return None
+
+        try:
+            if arguments[0] not in self.commands:
+                raise ServerRequestException(
+                    "Unknown command {}, expected one of: {}.".format(
+                        arguments[0], ", ".join(sorted(self.commands))))
+            response = {'ok': True}
+            response.update(self.commands[arguments[0]](arguments[1:]))
+        except (ServerRequestException, generate.GenerationException,
+                ValueError) as ex:
+            response = {'ok': False, 'error': str(ex.args[0])}
+        except (IOError, OSError) as ex:
+            response = {'ok': False, 'error': str(ex)}
+        except Exception as ex:
+            # A bad request must never take the other clients down with it.
+            sys.stderr.write("Request {!r} failed:\n".format(line.strip()))
+            traceback.print_exc()
+            response = {'ok': False, 'error': "Internal error: {}".format(
+                ex.__class__.__name__)}
+
+        return json.dumps(response, ensure_ascii=False)
+
+    def roll(self, arguments):
+        die_codes, options = parse_options(
+            arguments, ('-a', '-d', '-crit'), ('-c', '-b', '-w'))
+        if len(die_codes) == 0:
+            raise ServerRequestException("Nothing to roll.")
+        if len([option for option in ('-a', '-d', '-crit', '-b', '-w')
+                if option in options]) > 1:
+            raise ServerRequestException(
+                "Only one of -a, -d, -crit, -b and -w can be used at a time.")
+        count = request_count(options, self.max_count)
+
+        results = {}
+        for die_code in die_codes:
+            roll = parse_roll(die_code, self.max_dice)
+            if options.get('-a') or options.get('-d'):
+                if len(roll.dice) != 1 or roll.dice[0][1] > 1 or \
+                        roll.dice[0][2] != 20:
+                    raise ServerRequestException(
+                        "Can only do a 1d20+x type of roll with {}.".format(
+                            "advantage" if options.get('-a')
+                            else "disadvantage"))
+                d20_rolls = combat.attack_die(roll).roll_batch(count * 2)
+                d20_rolls = d20_rolls.reshape(count, 2)
+                if options.get('-a'):
+                    totals = d20_rolls.max(axis=1) + roll.bonus
+                else:
+                    totals = d20_rolls.min(axis=1) + roll.bonus
+            elif options.get('-crit'):
+                totals = roll.critical().roll_totals(count)
+            elif '-b' in options:
+                totals = roll.roll_keep_batch(count, options['-b'], True)
+            elif '-w' in options:
+                totals = roll.roll_keep_batch(count, options['-w'], False)
+            else:
+                totals = roll.roll_totals(count)
+            results[die_code] = totals.tolist()
+
+        return {'results': results}
+
+    def attack(self, arguments):
+        positional, options = parse_options(
+            arguments, ('-a', '-d'), ('-c',))
+        if len(positional) != 3:
+            raise ServerRequestException(
+                "Usage: attack <attack_roll> <damage_roll> <target_ac> "
+                "[-a|-d] [-c count]")
+        count = request_count(options, self.max_count)
+
+        attack = parse_roll(positional[0], self.max_dice)
+        if len(attack.dice) == 0:
+            raise ServerRequestException(
+                "Attack roll {} has no die to roll.".format(positional[0]))
+        damage = parse_roll(positional[1], self.max_dice)
+        target_ac = int(positional[2])
+
+        attacks = []
+        for i in range(count):
+            attack_total, outcome, damage_total = combat.roll_attack(
+                attack, damage, target_ac, options.get('-a', False),
+                options.get('-d', False))
+            attacks.append({
+                'attack': attack_total,
+                'outcome': outcome.lower(),
+                'damage': damage_total})
+
+        return {'attacks': attacks}
+
+    def generate(self, arguments):
+        positional, options = parse_options(arguments, (), ('-c',))
+        if len(positional) != 1:
+            raise ServerRequestException(
+                "Usage: generate <template> [-c count]")
+        count = request_count(options, self.max_count)
+
+        # Edited word lists are picked up by the next request.
+        generate.refresh_word_lists()
+        aggregate_generator = self.load_template(positional[0] + ".txt")
+        samples = []
+        for i in range(count):
+            name_sequence, content_map = \
+                aggregate_generator.generate_sample()
+            samples.append([[name, content_map[name]]
+                            for name in name_sequence])
+
+        return {'samples': samples}
+
+    def load_template(self, template_file_name):
+        try:
+            modified = os.stat(template_file_name).st_mtime
+        except OSError:
+            raise ServerRequestException(
+                "Template {} not found.".format(template_file_name))
+
+        cached = self.templates.get(template_file_name)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+
+        with open(template_file_name, 'r') as template_file:
+            template_lines = template_file.readlines()
+        if len(template_lines) == 0 or \
+                template_lines[0].strip() != "TEMPLATE":
+            raise ServerRequestException(
+                "{} is not a template.".format(template_file_name))
+
+        aggregate_generator = generate.compile_template(
+            template_file_name, template_lines)
+        self.templates[template_file_name] = (modified, aggregate_generator)
+        return aggregate_generator
+
+
+async def serve_client(server, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                break
+
+            response = server.handle_line(line.decode('utf-8'))
+            if response is not None:
+                writer.write(response.encode('utf-8') + b"\n")
+                await writer.drain()
+    except (ConnectionError, UnicodeDecodeError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_socket(server, socket_path):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    unix_server = await asyncio.start_unix_server(
+        lambda reader, writer: serve_client(server, reader, writer),
+        path=socket_path)
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        async with unix_server:
+            await unix_server.serve_forever()
+    finally:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+async def serve_stdio(server):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    while True:
+        line = await reader.readline()
+        if len(line) == 0:
+            break
+
+        response = server.handle_line(line.decode('utf-8'))
+        if response is not None:
+            sys.stdout.write(response + "\n")
+            sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Long-running roll server that answers roll, attack and generate requests, one request and one JSON response per line, ex: "roll 1d20+5 -a", "roll 4d6 -b 3 -c 6", "attack 1d20+5 2d6+3 15 -c 3", "generate main_template -c 2".')
+    parser.add_argument(
+        '-s',
+        '--socket',
+        help='serve clients on this Unix socket instead of stdin/stdout')
+    parser.add_argument(
+        '--max_count',
+        help='largest -c a single request may ask for',
+        type=int,
+        default=10000)
+    parser.add_argument(
+        '--max_dice',
+        help='most dice a single die code in a request may roll',
+        type=int,
+        default=1000)
+    parser.add_argument(
+        '--seed',
+        help='seed for all rolls made by the server',
+        type=int)
+    parser.add_argument(
+        '--rng',
+        help='NumPy bit generator for batch rolls',
+        choices=sorted(du.BIT_GENERATORS),
+        default='pcg64')
+
+    args = parser.parse_args()
+
+    du.seed_random_source(args.seed, args.rng)
+
+    server = RollServer(args.max_count, args.max_dice)
+    try:
+        if args.socket is not None:
+            asyncio.run(serve_socket(server, args.socket))
+        else:
+            asyncio.run(serve_stdio(server))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == '__main__':
+    main()